@@ -22,7 +22,24 @@ from PyQt4 import QtGui as Qt
 from PyQt4 import QtCore as Qc
 
 from config import *
+import os
+import re
+import csv
 import time
+import Queue
+import struct
+import hashlib
+import itertools
+import functools
+import contextlib
+import threading
+import multiprocessing
+import copy_reg
+import cPickle
+from collections import OrderedDict
+
+import MySQLdb
+import MySQLdb.cursors
 
 from PyPore.parsers import *
 from PyPore.database import *
@@ -33,6 +50,1639 @@ from PyPore.alignment import *
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt4agg import NavigationToolbar2QTAgg as NavigationToolbar
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+
+def portable( parser ):
+    '''
+    Return a picklable description of a parser, as a tuple of its class and
+    every attribute which survives pickling. This drops the Qt widgets built by
+    the GUI() call, but keeps the parameters read in by set_params().
+    '''
+    state = {}
+    for key, value in parser.__dict__.items():
+        try:
+            cPickle.dumps( value, cPickle.HIGHEST_PROTOCOL )
+        except Exception:
+            continue
+        state[ key ] = value
+    return parser.__class__, state
+
+def rebuild( spec ):
+    '''
+    Build a parser back up from the description given by portable().
+    '''
+    cls, state = spec
+    parser = cls()
+    parser.__dict__.update( state )
+    return parser
+
+class ABFReader( object ):
+    '''
+    Memory-maps the data section of an Axon Binary File, so that any stretch of the
+    first recorded channel can be read in pA without loading the rest of the file.
+    Both the ABF1 and ABF2 header layouts are supported.
+    '''
+    abf2_sections = [ 'Protocol', 'ADC', 'DAC', 'Epoch', 'ADCPerDAC', 'EpochPerDAC',
+                      'UserList', 'StatsRegion', 'Math', 'Strings', 'Data' ]
+
+    def __init__( self, filename ):
+        self.filename = filename
+        with open( filename, "rb" ) as infile:
+            header = infile.read( 6144 )
+            if header[:4] == "ABF ":
+                self._read_abf1( header )
+            elif header[:4] == "ABF2":
+                self._read_abf2( infile, header )
+            else:
+                raise ValueError( "{} is not an ABF file".format( filename ) )
+
+        self.n = self.n_samples // self.channels
+        self.data = np.memmap( filename, dtype=self.dtype, mode='r', offset=self.offset,
+                               shape=( self.n, self.channels ) )
+        self.second = 1e6 / self.interval
+        self.timestep = 1. / self.second
+
+    def read( self, start, end ):
+        '''
+        Return the current, in pA, of the samples from start up to end.
+        '''
+        return np.array( self.data[ start:end, 0 ], dtype=np.float64 ) * self.gain + self.zero
+
+    def _scale( self, data_format, adc_range, resolution, scale_factor, signal_gain, 
+                programmable_gain, telegraph_gain, instrument_offset, signal_offset ):
+        '''
+        Store how to turn the raw integers stored to the file into pA.
+        '''
+        if data_format == 0:
+            self.dtype = np.int16
+            self.gain = adc_range / ( resolution * scale_factor * signal_gain * 
+                                      programmable_gain * telegraph_gain )
+            self.zero = instrument_offset - signal_offset
+        else:
+            self.dtype = np.float32
+            self.gain, self.zero = 1., 0.
+
+    def _read_abf1( self, header ):
+        version, = struct.unpack_from( "<f", header, 4 )
+        n_samples, ignored = struct.unpack_from( "<ih", header, 10 )
+        data_block, = struct.unpack_from( "<i", header, 40 )
+        data_format, = struct.unpack_from( "<h", header, 100 )
+        channels, interval = struct.unpack_from( "<hf", header, 120 )
+        adc_range, = struct.unpack_from( "<f", header, 244 )
+        resolution, = struct.unpack_from( "<i", header, 252 )
+
+        # Per channel values are indexed by the physical channel sampled first
+        c, = struct.unpack_from( "<h", header, 410 )
+        programmable_gain, = struct.unpack_from( "<f", header, 730 + 4*c )
+        scale_factor, = struct.unpack_from( "<f", header, 922 + 4*c )
+        instrument_offset, = struct.unpack_from( "<f", header, 986 + 4*c )
+        signal_gain, = struct.unpack_from( "<f", header, 1050 + 4*c )
+        signal_offset, = struct.unpack_from( "<f", header, 1114 + 4*c )
+        telegraph_gain = 1.
+        if len( header ) >= 4640 and struct.unpack_from( "<h", header, 4512 + 2*c )[0]:
+            telegraph_gain, = struct.unpack_from( "<f", header, 4576 + 4*c )
+
+        self._scale( data_format, adc_range, resolution, scale_factor, signal_gain,
+                     programmable_gain, telegraph_gain, instrument_offset, signal_offset )
+        self.channels = channels
+        self.n_samples = n_samples
+        self.interval = interval * channels
+        self.offset = data_block * 512 + ignored * np.dtype( self.dtype ).itemsize
+
+    def _read_abf2( self, infile, header ):
+        data_format, = struct.unpack_from( "<H", header, 30 )
+        sections = { name: struct.unpack_from( "<IIq", header, 76 + 16*i ) 
+                        for i, name in enumerate( self.abf2_sections ) }
+
+        block, size, count = sections['Protocol']
+        infile.seek( block * 512 )
+        protocol = infile.read( size )
+        interval, = struct.unpack_from( "<f", protocol, 2 )
+        adc_range, = struct.unpack_from( "<f", protocol, 110 )
+        resolution, = struct.unpack_from( "<i", protocol, 118 )
+
+        # Channels are stored in the order of the ADC section, so use its first entry
+        block, size, channels = sections['ADC']
+        infile.seek( block * 512 )
+        adc = infile.read( size )
+        telegraph, = struct.unpack_from( "<h", adc, 2 )
+        telegraph_gain, = struct.unpack_from( "<f", adc, 6 )
+        programmable_gain, = struct.unpack_from( "<f", adc, 28 )
+        scale_factor, instrument_offset, signal_gain, signal_offset = struct.unpack_from( "<ffff", adc, 40 )
+
+        self._scale( data_format, adc_range, resolution, scale_factor, signal_gain,
+                     programmable_gain, telegraph_gain if telegraph else 1., 
+                     instrument_offset, signal_offset )
+
+        block, size, n_samples = sections['Data']
+        self.channels = channels
+        self.n_samples = n_samples
+        self.interval = interval
+        self.offset = block * 512
+
+def stream_events( reader, event_detector, chunk_size, overlap ):
+    '''
+    Run an event detector over a trace in overlapping chunks, yielding a tuple of
+    ( start index, current ) for each event. An event which runs into the end of a
+    chunk is left for the next chunk, which starts overlap samples before it so the
+    detector sees the baseline leading into it. If an event is longer than a whole
+    chunk, that chunk is doubled until the event fits, so peak memory depends on the
+    chunk size and the longest event, never on the length of the file.
+    '''
+    n = reader.n
+    start, size, accepted = 0, chunk_size, 0
+    while start < n:
+        end = min( start + size, n )
+        current = reader.read( start, end )
+        resume = end
+
+        for segment in event_detector.parse( current ):
+            event_start = start + int( segment.start )
+            event_end = event_start + len( segment.current )
+            if event_start < accepted:
+                continue # The rest of an event accepted in the previous chunk
+            if event_end >= end and end < n:
+                resume = event_start # Cut off by the end of this chunk
+                break
+            yield event_start, np.array( segment.current )
+            accepted = event_end
+
+        if end == n:
+            break
+        if resume - overlap <= start:
+            size *= 2
+        else:
+            start, size = resume - overlap, chunk_size
+
+def stream_file( filename, event_detector, chunk_size, overlap=STREAM_OVERLAP ):
+    '''
+    Detect the events in an ABF file by streaming it from disk in chunks of
+    chunk_size samples, instead of loading the full trace. The returned file
+    holds the events but not the trace itself.
+    '''
+    reader = ABFReader( filename+".abf" )
+    file = File( current=np.zeros( 0 ), timestep=reader.timestep, filename=filename )
+    file.events = [ Event( current=current, start=start * reader.timestep, 
+                           timestep=reader.timestep, file=file ) 
+                    for start, current in stream_events( reader, event_detector, 
+                                                         chunk_size, overlap ) ]
+    return file
+
+def strip_trace( file ):
+    '''
+    Drop the raw trace of an analyzed file, keeping its events and their segments.
+    Their currents are copied first, as they may be views into the trace which would
+    keep the whole of it alive, or in a pickle, written out in full.
+    '''
+    for event in file.events:
+        if event.current is not None:
+            event.current = np.array( event.current )
+        for segment in getattr( event, 'segments', None ) or []:
+            if segment.current is not None:
+                segment.current = np.array( segment.current )
+    file.current = np.zeros( 0 )
+    return file
+
+def analyze_file( job ):
+    '''
+    Run the full analysis pipeline on a single file. This is the unit of work
+    handed to the worker processes, so it takes in and returns only picklable
+    objects. A job is a tuple of ( filename, event detector, segmenter, filter
+    order, filter cutoff, chunk size ), where both parsers are given as by
+    portable(). If the chunk size is not None, the file is streamed from disk.
+    The file is returned without its raw trace, so only the events are sent back.
+    '''
+    filename, detector_spec, segmenter_spec, order, cutoff, chunk_size = job
+    event_detector = rebuild( detector_spec )
+    segmenter = rebuild( segmenter_spec )
+
+    if chunk_size:
+        file = stream_file( filename, event_detector, chunk_size )
+    else:
+        file = File( filename+".abf" )
+        file.parse( parser=event_detector )
+    for event in file.events:
+        if order and cutoff:
+            event.filter( order=order, cutoff=cutoff )
+        event.parse( parser=segmenter )
+    return strip_trace( file )
+
+class JobPool( object ):
+    '''
+    A pool of worker processes which is never handed more jobs than it has
+    workers. The remaining jobs wait in this process until a worker frees
+    up, so cancelling the pool drops every job which has not started yet.
+    The workers are shut down once imap is done, unless the pool is
+    persistent, in which case it can run imap again and must be closed.
+    '''
+    def __init__( self, workers, persistent=False ):
+        self.workers = workers
+        self.persistent = persistent
+        self.pool = multiprocessing.Pool( workers )
+        self.cancelled = False
+        self.closed = False
+
+    def imap( self, function, jobs ):
+        '''
+        Apply the function to each job, yielding ( index, result, error ) tuples in
+        the order that the jobs finish. If a job raised an exception, result is None
+        and error is that exception, and the remaining jobs carry on.
+        '''
+        jobs = enumerate( jobs )
+        pending = {}
+        try:
+            for i, job in itertools.islice( jobs, self.workers ):
+                pending[i] = self.pool.apply_async( function, ( job, ) )
+
+            while pending and not self.cancelled:
+                done = [ i for i, result in pending.items() if result.ready() ]
+                for i in done:
+                    result = pending.pop( i )
+                    for j, job in itertools.islice( jobs, 1 ):
+                        pending[j] = self.pool.apply_async( function, ( job, ) )
+                    try:
+                        yield i, result.get(), None
+                    except Exception as e:
+                        yield i, None, e
+                    if self.cancelled:
+                        break
+                if not done:
+                    time.sleep( 0.01 )
+        finally:
+            # Workers still busy here have either been cancelled or abandoned
+            if pending or self.cancelled:
+                self.close( terminate=True )
+            elif not self.persistent:
+                self.close()
+
+    def cancel( self ):
+        '''Drop the queued jobs, and stop the ones which are running.'''
+        self.cancelled = True
+
+    def close( self, terminate=False ):
+        '''Shut the workers down, stopping any which are still running if terminate.'''
+        if not self.closed:
+            self.closed = True
+            if terminate:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+
+# The columns of the analysis tables, which hold analyses saved to the database. Each
+# table also has an auto-increment ID column, and events and segments point back to
+# their analysis through an AnalysisID column.
+ANALYSIS_COLUMNS = ( "Filename", "EventDetector", "EventDetectorParams", "Segmenter",
+                     "SegmenterParams", "FilterCutoff", "FilterOrder" )
+EVENT_COLUMNS = ( "SerialID", "Start", "End", "Mean", "STD" )
+SEGMENT_COLUMNS = ( "EventSerialID", "SerialID", "Start", "End", "Mean", "STD" )
+
+class ConnectionPool( object ):
+    '''
+    A pool of MySQL connections to the database given in config.py. Connections are
+    opened as they are needed and handed back to the pool after each use, so a run of
+    queries pays for a connection once instead of once per query.
+    '''
+    def __init__( self, size=DATABASE_POOL_SIZE ):
+        self.size = size
+        self.idle = Queue.Queue()
+        self.lock = threading.Lock()
+        self.opened = 0
+
+    def _open( self ):
+        '''
+        Open a new connection, giving its place in the pool back if that fails.
+        '''
+        try:
+            return MySQLdb.connect( host=DATABASE_HOST, user=DATABASE_USER, 
+                                    passwd=DATABASE_PASSWORD, db=DATABASE,
+                                    connect_timeout=DATABASE_TIMEOUT )
+        except:
+            with self.lock:
+                self.opened -= 1
+            raise
+
+    def acquire( self ):
+        '''
+        Take a connection out of the pool, opening a new one if none are idle and
+        fewer than size are open, and otherwise waiting up to DATABASE_TIMEOUT
+        seconds for one to be released.
+        '''
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            with self.lock:
+                grow = self.opened < self.size
+                if grow:
+                    self.opened += 1
+            if grow:
+                return self._open()
+            try:
+                return self.idle.get( timeout=DATABASE_TIMEOUT )
+            except Queue.Empty:
+                raise MySQLdb.OperationalError( "No database connection was released within "
+                                                "{} seconds".format( DATABASE_TIMEOUT ) )
+
+    def release( self, conn, broken=False ):
+        '''
+        Give a connection back to the pool, ending its transaction. A broken
+        connection is closed and dropped instead.
+        '''
+        if not broken:
+            try:
+                conn.rollback()
+            except MySQLdb.OperationalError:
+                broken = True
+        if broken:
+            with self.lock:
+                self.opened -= 1
+            try:
+                conn.close()
+            except MySQLdb.Error:
+                pass
+        else:
+            self.idle.put( conn )
+
+    @contextlib.contextmanager
+    def connection( self ):
+        '''
+        Borrow a connection for the length of a with block. Everything done in the
+        block is one transaction, which is committed at the end of the block or
+        rolled back if it raises.
+        '''
+        conn = self.acquire()
+        try:
+            yield conn
+            conn.commit()
+        except MySQLdb.OperationalError:
+            # The connection itself may be broken, so do not put it back
+            self.release( conn, broken=True )
+            raise
+        except:
+            self.release( conn )
+            raise
+        else:
+            self.release( conn )
+
+def analysis_rows( file ):
+    '''
+    Return the rows of the event table and of the segment table for an analyzed
+    file, in the layout of EVENT_COLUMNS and SEGMENT_COLUMNS without the analysis ID.
+    '''
+    events, segments = [], []
+    for i, event in enumerate( file.events ):
+        events.append( ( i, event.start, event.start + event.duration, event.mean, event.std ) )
+        if event.n == 'N/A':
+            continue
+        for j, segment in enumerate( event.segments ):
+            start = event.start + segment.start
+            segments.append( ( i, j, start, start + segment.duration, segment.mean, segment.std ) )
+    return events, segments
+
+def analysis_tables_match( pool ):
+    '''
+    Return whether the analysis tables exist with every column which the batched
+    reads and writes use. Databases laid out otherwise are read and written through
+    File.from_database and File.to_database instead, one file at a time.
+    '''
+    tables = ( ( ANALYSIS_TABLE, ( "ID", ) + ANALYSIS_COLUMNS ),
+               ( EVENT_TABLE, ( "AnalysisID", ) + EVENT_COLUMNS ),
+               ( SEGMENT_TABLE, ( "AnalysisID", ) + SEGMENT_COLUMNS ) )
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        for table, columns in tables:
+            try:
+                cursor.execute( "SHOW COLUMNS FROM {}".format( table ) )
+            except MySQLdb.ProgrammingError:
+                return False
+            if not set( columns ) <= set( row[0] for row in cursor.fetchall() ):
+                return False
+        cursor.close()
+    return True
+
+def database_options( metadata ):
+    '''
+    Return the keyword arguments of File.from_database for the analysis parameters
+    in metadata, which are those of ANALYSIS_COLUMNS after the filename.
+    '''
+    keys = ( "eventDetector", "eventDetectorParams", "segmenter", "segmenterParams", 
+             "filterCutoff", "filterOrder" )
+    options = dict( zip( keys, metadata ) )
+    options.update( database=DATABASE, host=DATABASE_HOST, password=DATABASE_PASSWORD,
+                    user=DATABASE_USER )
+    return options
+
+class DatabaseWriter( threading.Thread ):
+    '''
+    Saves analyzed files to the analysis tables in a background thread, so that saving
+    one file happens at the same time as analyzing the next. One pooled connection is
+    used for the whole run, and each file is written in a single transaction with
+    multi-row inserts of DATABASE_BATCH_SIZE rows. Each analysis is added alongside
+    any earlier ones, as File.to_database does. If the tables are not laid out as
+    expected, files are written with File.to_database instead. Call close() to wait
+    for every queued file to be written.
+    '''
+    def __init__( self, pool, metadata, on_error=None, batched=True ):
+        super( DatabaseWriter, self ).__init__()
+        self.daemon = True
+        self.pool = pool
+        self.metadata = metadata
+        self.on_error = on_error
+        self.batched = batched
+        self.queue = Queue.Queue()
+
+    def put( self, i, file ):
+        ''' Queue a file to be written, where i is its row in the file table. '''
+        self.queue.put( ( i, file ) )
+
+    def close( self ):
+        ''' Wait until every queued file has been written. '''
+        self.queue.put( None )
+        self.join()
+
+    def run( self ):
+        if not self.batched:
+            for i, file in iter( self.queue.get, None ):
+                try:
+                    file.to_database( database=DATABASE, host=DATABASE_HOST, 
+                                      password=DATABASE_PASSWORD, user=DATABASE_USER )
+                except Exception as e:
+                    self._error( i, e )
+            return
+
+        try:
+            with self.pool.connection() as conn:
+                for i, file in iter( self.queue.get, None ):
+                    try:
+                        self._write( conn, file )
+                        conn.commit()
+                    except MySQLdb.OperationalError as e:
+                        self._error( i, e ) # The queue only holds the files after this one
+                        raise
+                    except Exception as e:
+                        conn.rollback()
+                        self._error( i, e )
+        except Exception as e:
+            # Without a working connection none of the remaining files can be written
+            for i, file in iter( self.queue.get, None ):
+                self._error( i, e )
+
+    def _error( self, i, error ):
+        if self.on_error is not None:
+            self.on_error( i, error )
+
+    def _write( self, conn, file ):
+        cursor = conn.cursor()
+        filename = file.filename.split("\\")[-1]
+        metadata = ( filename, ) + self.metadata
+        cursor.execute( insert_statement( ANALYSIS_TABLE, ANALYSIS_COLUMNS ), metadata )
+        analysis_id = cursor.lastrowid
+
+        events, segments = analysis_rows( file )
+        for table, columns, rows in ( EVENT_TABLE, EVENT_COLUMNS, events ), \
+                                    ( SEGMENT_TABLE, SEGMENT_COLUMNS, segments ):
+            statement = insert_statement( table, ( "AnalysisID", ) + columns )
+            for k in xrange( 0, len( rows ), DATABASE_BATCH_SIZE ):
+                cursor.executemany( statement, [ ( analysis_id, ) + row 
+                                        for row in rows[ k:k+DATABASE_BATCH_SIZE ] ] )
+        cursor.close()
+
+def load_analyses( pool, filenames, metadata ):
+    '''
+    Fetch the stored analyses of many files at once. The analysis IDs of every file
+    are found with one query per DATABASE_BATCH_SIZE files, and then the events and
+    segments of all of those analyses with one query per table, instead of several
+    round-trips per file. Metadata is the tuple of parameters other than the filename
+    in ANALYSIS_COLUMNS. Returns a dictionary mapping each filename which has a stored
+    analysis to a tuple of its ( event rows, segment rows ), in the layout of
+    EVENT_COLUMNS and SEGMENT_COLUMNS.
+    '''
+    filenames = list( filenames )
+    analyses = {}
+    clauses = " AND ".join( "{} <=> %s".format( c ) for c in ANALYSIS_COLUMNS[1:] )
+
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        for k in xrange( 0, len( filenames ), DATABASE_BATCH_SIZE ):
+            batch = filenames[ k:k+DATABASE_BATCH_SIZE ]
+            cursor.execute( "SELECT ID, Filename FROM {} WHERE Filename IN ( {} ) AND {} ORDER BY ID".format(
+                                ANALYSIS_TABLE, ", ".join( "%s" for f in batch ), clauses ),
+                            tuple( batch ) + tuple( metadata ) )
+            # Keep the most recent analysis of each file
+            analyses.update( { filename: analysis_id for analysis_id, filename in cursor.fetchall() } )
+        if not analyses:
+            return {}
+
+        ids = { analysis_id: filename for filename, analysis_id in analyses.items() }
+        rows = {}
+        for table, columns in ( EVENT_TABLE, EVENT_COLUMNS ), ( SEGMENT_TABLE, SEGMENT_COLUMNS ):
+            rows[ table ] = { analysis_id: [] for analysis_id in ids }
+            cursor.execute( "SELECT AnalysisID, {} FROM {} WHERE AnalysisID IN ( {} ) ORDER BY AnalysisID, {}".format(
+                                ", ".join( columns ), table, ", ".join( "%s" for i in ids ), 
+                                ", ".join( c for c in columns if "SerialID" in c ) ),
+                            tuple( ids ) )
+            for row in cursor:
+                rows[ table ][ row[0] ].append( row[1:] )
+        cursor.close()
+
+    return { filename: ( rows[ EVENT_TABLE ][ analysis_id ], rows[ SEGMENT_TABLE ][ analysis_id ] )
+                for analysis_id, filename in ids.items() }
+
+def build_file( filename, events, segments, order=None, cutoff=None ):
+    '''
+    Build an analyzed file back up from the rows stored to the analysis tables, as
+    returned by load_analyses. The current of each event is read from the ABF file,
+    and filtered again if a filter was used in the analysis.
+    '''
+    reader = ABFReader( filename+".abf" )
+    file = File( current=np.zeros( 0 ), timestep=reader.timestep, filename=filename )
+    file.events = []
+
+    by_event = {}
+    for event_id, serial_id, start, end, mean, std in segments:
+        by_event.setdefault( event_id, [] ).append( ( start, end ) )
+
+    for serial_id, start, end, mean, std in events:
+        a, b = int( round( start * reader.second ) ), int( round( end * reader.second ) )
+        event = Event( current=reader.read( a, b ), start=start, timestep=reader.timestep, file=file )
+        if order and cutoff:
+            event.filter( order=order, cutoff=cutoff )
+
+        event.segments = []
+        for segment_start, segment_end in by_event.get( serial_id, [] ):
+            a = int( round( ( segment_start - start ) * reader.second ) )
+            b = int( round( ( segment_end - start ) * reader.second ) )
+            event.segments.append( Segment( current=event.current[ a:b ], start=segment_start - start,
+                                            duration=segment_end - segment_start, event=event ) )
+        file.events.append( event )
+    return file
+
+def insert_statement( table, columns ):
+    '''
+    Return a parameterized INSERT statement into the given columns of a table. Given
+    to executemany, MySQLdb sends the rows as a single multi-row insert.
+    '''
+    return "INSERT INTO {} ( {} ) VALUES ( {} )".format( table, ", ".join( columns ), 
+                                                         ", ".join( "%s" for c in columns ) )
+
+def reduce_parser( parser ):
+    '''
+    Pickle a parser through portable(), so that files which hold references to the
+    parsers which analyzed them can be pickled even if those parsers own Qt widgets.
+    Register it for a parser class with copy_reg.pickle( cls, reduce_parser ).
+    '''
+    return rebuild, ( portable( parser ), )
+
+def parser_key( parser ):
+    '''
+    Return a string which identifies a parser by its class and parameters.
+    '''
+    cls, state = portable( parser )
+    return "{}{}".format( cls.__name__, sorted( state.items() ) )
+
+class AnalysisCache( object ):
+    '''
+    A local cache of analyzed files on disk. Entries are keyed by the hash of the
+    contents of the ABF file, the class and parameters of the event detector and of
+    the segmenter, the filter order and cutoff, and whether the file was streamed,
+    so renaming a file still hits and changing a parameter never does. Only the
+    events and segments of a file are stored, never its raw trace. The total size of the entries is kept under
+    max_size bytes by evicting the least recently used ones. Content hashes are
+    remembered by path, size and modification time, so a file is only hashed again
+    when it changes.
+    '''
+    def __init__( self, directory=ANALYSIS_CACHE_DIR, max_size=ANALYSIS_CACHE_SIZE ):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.index_path = os.path.join( directory, "index.pkl" )
+
+        if not os.path.isdir( directory ):
+            os.makedirs( directory )
+        try:
+            with open( self.index_path, "rb" ) as infile:
+                self.entries, self.hashes = cPickle.load( infile )
+        except ( IOError, EOFError, ValueError, cPickle.UnpicklingError ):
+            # The entries are in least to most recently used order
+            self.entries, self.hashes = OrderedDict(), {}
+
+    @property
+    def size( self ):
+        return sum( self.entries.values() )
+
+    def __contains__( self, key ):
+        return key in self.entries
+
+    def content_hash( self, filename ):
+        '''
+        Return the SHA-1 hash of the contents of a file.
+        '''
+        stat = os.stat( filename )
+        stamp = ( os.path.abspath( filename ), stat.st_size, stat.st_mtime )
+        if stamp not in self.hashes:
+            digest = hashlib.sha1()
+            with open( filename, "rb" ) as infile:
+                for block in iter( lambda: infile.read( 1 << 20 ), "" ):
+                    digest.update( block )
+            self.hashes[ stamp ] = digest.hexdigest()
+        return self.hashes[ stamp ]
+
+    def key( self, filename, event_detector, segmenter, order, cutoff, chunk_size=None ):
+        '''
+        Return the key of the analysis of an ABF file with the given parameters.
+        '''
+        parts = ( self.content_hash( filename ), parser_key( event_detector ), 
+                  parser_key( segmenter ), order, cutoff, 
+                  "streamed" if chunk_size else "whole" )
+        return hashlib.sha1( repr( parts ) ).hexdigest()
+
+    def get( self, key ):
+        '''
+        Return the cached file stored under this key, or None if there is none.
+        '''
+        with self.lock:
+            if key in self.entries:
+                try:
+                    with open( self._path( key ), "rb" ) as infile:
+                        file = cPickle.load( infile )
+                except ( IOError, EOFError, ValueError, cPickle.UnpicklingError ):
+                    self._remove( key )
+                else:
+                    self.entries[ key ] = self.entries.pop( key )
+                    self.hits += 1
+                    self._save_index()
+                    return file
+            self.misses += 1
+            return None
+
+    def put( self, key, file ):
+        '''
+        Store a file under this key, evicting the least recently used entries until
+        the cache fits in max_size again. The raw trace of the file is dropped first.
+        '''
+        strip_trace( file )
+        with self.lock:
+            path = self._path( key )
+            try:
+                with open( path, "wb" ) as outfile:
+                    cPickle.dump( file, outfile, cPickle.HIGHEST_PROTOCOL )
+            except ( IOError, OSError, TypeError, cPickle.PicklingError ):
+                # A file which cannot be cached is simply analyzed again next time
+                self._remove( key )
+                return
+            self.entries.pop( key, None )
+            self.entries[ key ] = os.path.getsize( path )
+
+            while len( self.entries ) > 1 and self.size > self.max_size:
+                self._remove( next( iter( self.entries ) ) )
+            self._save_index()
+
+    def stats( self ):
+        '''
+        Return a short description of the hit rate and size of the cache.
+        '''
+        return "Analysis Cache: {} hits, {} misses, {} files, {:.1f} of {:.1f} MB".format(
+                    self.hits, self.misses, len( self.entries ), 
+                    self.size / 1048576., self.max_size / 1048576. )
+
+    def _path( self, key ):
+        return os.path.join( self.directory, key + ".pkl" )
+
+    def _remove( self, key ):
+        self.entries.pop( key, None )
+        try:
+            os.remove( self._path( key ) )
+        except OSError:
+            pass
+
+    def _save_index( self ):
+        with open( self.index_path, "wb" ) as outfile:
+            cPickle.dump( ( self.entries, self.hashes ), outfile, cPickle.HIGHEST_PROTOCOL )
+
+def read_distributions( filename ):
+    '''
+    Reads in a properly formatted HMM generation file. All files must be line separated
+    distribution objects of proper python syntax, such as the following:
+
+
+    # This file stores the distributions of construct X
+    # Contact: Jacob Schreiber
+    #          jmschreiber@gmail.com
+    NormalDistribution( 4, 2 )
+    NormalDistribution( 2, 7 )
+    NormalDistribution( 2, 3 )
+    InverseGammaDistribution( 1, 0.5 )
+    GaussianKernelDensity( [ 0.4, 0.6, 0.3, 0.2, 0.6 ], bandwidth=0.5 )
+    GaussianKernelDensity( [ 6, 7, 6, 6.5, 6.4, 7.2, 4.1 ], bandwidth=0.1 )
+    LambdaDistribution( lambda x: 4 <= x <= 6 )
+    '''
+
+    with open( filename, 'r' ) as infile:
+        return map( eval, filter( lambda line: not line.startswith( '#' ), infile ) )
+
+def hmm_options( name ):
+    '''
+    Return everything besides the definition file which goes into building a model.
+    '''
+    return ( name, NanoporeGlobalAlignmentModule.__name__, tuple( HMM_INSERT_RANGE ) )
+
+def build_hmm( filename, name ):
+    '''
+    Build a profile HMM from a definition file. Returns the distributions read from
+    the file and the model.
+    '''
+    distributions = read_distributions( filename )
+    return distributions, profile_model( distributions, name )
+
+def profile_model( distributions, name ):
+    '''
+    Build a profile HMM with one module for each distribution.
+    '''
+    return ModularProfileModel( NanoporeGlobalAlignmentModule, 
+                                distributions, 
+                                name, 
+                                insert=UniformDistribution( *HMM_INSERT_RANGE ) )
+
+class ModelCache( object ):
+    '''
+    A local cache on disk of HMMs built from definition files, so that a model is
+    built once and then loaded in every later session. Models are keyed by the hash
+    of the contents of their file and the options they were built with, and an
+    index keeps the file and key of each model by name. Models which cannot be
+    pickled, such as those with a LambdaDistribution, are built every time.
+    '''
+    def __init__( self, directory=HMM_CACHE_DIR ):
+        self.directory = directory
+        self.index_path = os.path.join( directory, "index.pkl" )
+
+        if not os.path.isdir( directory ):
+            os.makedirs( directory )
+        try:
+            with open( self.index_path, "rb" ) as infile:
+                self.index = cPickle.load( infile )
+        except ( IOError, EOFError, ValueError, cPickle.UnpicklingError ):
+            self.index = {}
+
+    def key( self, filename, name ):
+        '''
+        Return the key of the model built from a file under a name.
+        '''
+        digest = hashlib.sha1()
+        with open( filename, "rb" ) as infile:
+            for block in iter( lambda: infile.read( 1 << 20 ), "" ):
+                digest.update( block )
+        digest.update( repr( hmm_options( name ) ) )
+        return digest.hexdigest()
+
+    def build( self, filename, name ):
+        '''
+        Return the distributions and model built from a file under a name, loading
+        them from the cache if they are in it and building and storing them if not.
+        '''
+        key = self.key( filename, name )
+        built = self._load( key )
+        if built is None:
+            built = build_hmm( filename, name )
+            self._store( key, built )
+        self._index( name, filename, key )
+        return built
+
+    def load( self ):
+        '''
+        Return the models of every name in the index, keyed by name. A model whose
+        file has changed since is built again, and one whose file is gone is loaded
+        as it was last built.
+        '''
+        models = {}
+        for name, ( filename, key ) in self.index.items():
+            try:
+                if os.path.exists( filename ):
+                    distributions, models[ name ] = self.build( filename, name )
+                else:
+                    distributions, models[ name ] = self._load( key )
+            except Exception:
+                pass # A file which no longer builds is left out until imported again
+        return models
+
+    def _path( self, key ):
+        return os.path.join( self.directory, key + ".pkl" )
+
+    def _load( self, key ):
+        try:
+            with open( self._path( key ), "rb" ) as infile:
+                return cPickle.load( infile )
+        except ( IOError, EOFError, ValueError, cPickle.UnpicklingError ):
+            return None
+
+    def _store( self, key, built ):
+        try:
+            with open( self._path( key ), "wb" ) as outfile:
+                cPickle.dump( built, outfile, cPickle.HIGHEST_PROTOCOL )
+        except ( IOError, OSError, TypeError, AttributeError, cPickle.PicklingError ):
+            self._remove( key )
+
+    def _index( self, name, filename, key ):
+        old = self.index.get( name )
+        self.index[ name ] = ( filename, key )
+        if old is not None and old[1] != key and old[1] not in [ k for f, k in self.index.values() ]:
+            self._remove( old[1] )
+        with open( self.index_path, "wb" ) as outfile:
+            cPickle.dump( self.index, outfile, cPickle.HIGHEST_PROTOCOL )
+
+    def _remove( self, key ):
+        try:
+            os.remove( self._path( key ) )
+        except OSError:
+            pass
+
+class EventStore( object ):
+    '''
+    A columnar copy of the events and segments of an experiment, kept next to the
+    Event and Segment objects so that windows can select and plot whole columns with
+    NumPy instead of looping over objects. It is built once, after an analysis, and
+    holds for events their start, mean, std, duration, segment count, file index and
+    sample index, and for segments the same along with the index of their parent
+    event. Segment starts are from the start of the file. The segments of event i
+    are segment_offsets[i] up to segment_offsets[i+1].
+
+    next_match finds the next event with a summary in a range in constant time, from
+    a table built the first time that range is asked for.
+    '''
+    summaries = { 'Mean (pA)': 'event_mean', 'Duration (s)': 'event_duration', 
+                  'Segment Count': 'event_count' }
+
+    def __init__( self, experiment ):
+        self.filenames = []
+        self.sample_labels = []
+        samples = {}
+        events, segments = [], []
+
+        for f, file in enumerate( experiment.files ):
+            self.filenames.append( file.filename )
+            for event in file.events:
+                try:
+                    label = event.sample.label
+                except AttributeError:
+                    label = "Aggregate Data"
+                if label not in samples:
+                    samples[ label ] = len( self.sample_labels )
+                    self.sample_labels.append( label )
+                s, e = samples[ label ], len( events )
+
+                event_segments = event.segments if event.n != 'N/A' else []
+                events.append( ( event.start, event.mean, event.std, event.duration, 
+                                 len( event_segments ), f, s ) )
+                segments.extend( ( event.start + segment.start, segment.mean, segment.std, 
+                                   segment.duration, f, s, e ) for segment in event_segments )
+
+        events = np.array( events, dtype=np.float64 ).reshape( -1, 7 )
+        segments = np.array( segments, dtype=np.float64 ).reshape( -1, 7 )
+
+        self.event_start, self.event_mean, self.event_std, self.event_duration = events[:,:4].T.copy()
+        self.event_count, self.event_file, self.event_sample = events[:,4:].T.astype( np.int64 )
+
+        self.segment_start, self.segment_mean, self.segment_std, self.segment_duration = segments[:,:4].T.copy()
+        self.segment_file, self.segment_sample, self.segment_event = segments[:,4:].T.astype( np.int64 )
+
+        self.segment_offsets = np.concatenate( ( [0], np.cumsum( self.event_count ) ) )
+        self.next_matches = {}
+
+    def next_match( self, summary, low, high, i ):
+        '''
+        Return the index of the first event after event i, wrapping around to the
+        start, whose summary lies between low and high, or None if no event does.
+        '''
+        key = ( summary, low, high )
+        if key not in self.next_matches:
+            values = getattr( self, self.summaries[ summary ] )
+            n = values.shape[0]
+            positions = np.where( ( values >= low ) & ( values <= high ), np.arange( n ), n )
+            # The first match at or after each event, with n standing for none
+            self.next_matches[ key ] = np.minimum.accumulate( positions[::-1] )[::-1]
+        following = self.next_matches[ key ]
+        n = following.shape[0]
+        j = following[ i+1 ] if 0 <= i+1 < n else n
+        if j == n:
+            j = following[0] if n else n
+        return int( j ) if j < n else None
+
+    @property
+    def n_events( self ):
+        return self.event_start.shape[0]
+
+    @property
+    def n_segments( self ):
+        return self.segment_start.shape[0]
+
+def event_store( experiment ):
+    '''
+    Return the columnar store of an experiment, building it if it has none yet.
+    '''
+    if getattr( experiment, 'store', None ) is None:
+        experiment.store = EventStore( experiment )
+    return experiment.store
+
+RULE_FEATURES = { 'Event': { 'Duration (s)': 'event_duration', 'Mean (pA)': 'event_mean', 
+                             'STD (pA)': 'event_std', 'Segment Count': 'event_count' },
+                  'Segment': { 'Duration (s)': 'segment_duration', 'Mean (pA)': 'segment_mean',
+                               'STD (pA)': 'segment_std' } }
+RULE_TESTS = [ "Below", "Above", "Outside", "Outlier (per file)" ]
+
+def rule_matches( store, rule ):
+    '''
+    Return a boolean mask of the events which a rule excludes. A rule is a tuple of
+    ( level, feature, test, low, high ), with level a key of RULE_FEATURES and test
+    one of RULE_TESTS. Below and Above compare the feature with low, and Outside with
+    the range from low to high. Outlier (per file) matches values more than low
+    standard deviations away from the mean of their file. A segment rule excludes
+    every event with a segment which it matches.
+    '''
+    level, feature, test, low, high = rule
+    values = getattr( store, RULE_FEATURES[ level ][ feature ] ).astype( np.float64 )
+    if test == "Below":
+        matched = values < low
+    elif test == "Above":
+        matched = values > low
+    elif test == "Outside":
+        matched = ( values < low ) | ( values > high )
+    else:
+        files = store.event_file if level == 'Event' else store.segment_file
+        n = len( store.filenames )
+        counts = np.maximum( np.bincount( files, minlength=n ), 1 )
+        means = np.bincount( files, values, n ) / counts
+        deviations = values - means[ files ]
+        stds = np.sqrt( np.bincount( files, deviations ** 2, n ) / counts )
+        matched = np.abs( deviations ) > low * stds[ files ]
+
+    if level == 'Segment':
+        events = np.zeros( store.n_events, dtype=bool )
+        events[ store.segment_event[ matched ] ] = True
+        return events
+    return matched
+
+def rule_name( rule ):
+    level, feature, test, low, high = rule
+    if test == "Outside":
+        return "{} {} Outside {} to {}".format( level, feature, low, high )
+    elif test == "Below" or test == "Above":
+        return "{} {} {} {}".format( level, feature, test, low )
+    return "{} {} More Than {} STD From Its File".format( level, feature, low )
+
+class ExclusionMask( object ):
+    '''
+    Which events of an experiment are excluded from analysis, as boolean masks
+    aligned with the events of its event store. Events are excluded by hand, in
+    manual, or by rules, in rules, and excluded is either. Excluding or including an
+    event is a single assignment, and the events and segments kept are found by mask
+    indexing.
+    '''
+    def __init__( self, n_events ):
+        self.manual = np.zeros( n_events, dtype=bool )
+        self.rules = np.zeros( n_events, dtype=bool )
+
+    @property
+    def excluded( self ):
+        return self.manual | self.rules
+
+    def toggle( self, i, excluded ):
+        '''
+        Exclude event i by hand, or include it again, even if a rule excludes it.
+        '''
+        self.manual[i] = excluded
+        if not excluded:
+            self.rules[i] = False
+
+    def is_excluded( self, i ):
+        return bool( self.manual[i] or self.rules[i] )
+
+    def apply( self, store, rules ):
+        '''
+        Exclude the events matched by any of the rules, in place of those excluded by
+        rules before. Returns, for each rule, the number of events it matches and the
+        number of those which were not already excluded by hand or by an earlier rule.
+        '''
+        self.rules = np.zeros_like( self.manual )
+        counts = []
+        for rule in rules:
+            matched = rule_matches( store, rule )
+            counts.append( ( int( matched.sum() ), int( ( matched & ~self.excluded ).sum() ) ) )
+            self.rules |= matched
+        return counts
+
+    def kept( self ):
+        ''' Return the indices of the events which are not excluded. '''
+        return np.where( ~self.excluded )[0]
+
+    def kept_segments( self, store ):
+        ''' Return the indices of the segments whose events are not excluded. '''
+        return np.where( ~self.excluded[ store.segment_event ] )[0]
+
+EXPORT_FORMATS = [ "CSV", "NumPy (.npz)", "NumPy Columns (.npy)" ]
+EXPORT_SPLITS = [ "Single Output", "Per File", "Per Sample" ]
+
+def export_tables( store, excluded=None, decodings=None ):
+    '''
+    Return the event and segment tables written out by export_store. Each is a tuple
+    of ( name, columns, file codes, sample codes ), where columns is a list of
+    ( key, CSV header, array ) tuples. Given a mask of excluded events, both tables
+    get a column marking the rows which are excluded. Given a decode cache, events
+    get the log probability of their Viterbi path and their log-likelihood under each
+    model, and segments their hidden state, all NaN where not decoded. With more than
+    one model, events also get the index of the model under which they are most
+    likely, in the order of the log-likelihood columns, or -1.
+    '''
+    events = [ ( "start", "Start", store.event_start ),
+               ( "mean", "Mean (pA)", store.event_mean ),
+               ( "std", "STD", store.event_std ),
+               ( "duration", "Duration (s)", store.event_duration ),
+               ( "segment_count", "Segment Count", store.event_count ) ]
+    segments = [ ( "start", "Start", store.segment_start ),
+                 ( "mean", "Mean (pA)", store.segment_mean ),
+                 ( "std", "STD", store.segment_std ),
+                 ( "duration", "Duration (s)", store.segment_duration ),
+                 ( "event", "Event", store.segment_event ) ]
+    if excluded is not None:
+        events.append( ( "excluded", "Excluded", excluded.astype( np.int8 ) ) )
+        segments.append( ( "excluded", "Excluded", excluded[ store.segment_event ].astype( np.int8 ) ) )
+    if decodings is not None:
+        names = [ name for name in decodings.names() if decodings.columns( name )[0].any() ]
+        for name in names:
+            decoded, logp, states, loglik = decodings.columns( name )
+            events.append( ( "viterbi_logp_" + safe_name( name ), 
+                             "Viterbi Log-Probability ({})".format( name ), 
+                             np.where( decoded, logp, np.nan ) ) )
+            events.append( ( "loglik_" + safe_name( name ), 
+                             "Log-Likelihood ({})".format( name ), 
+                             np.where( decoded, loglik, np.nan ) ) )
+            segments.append( ( "state_" + safe_name( name ), "Hidden State ({})".format( name ),
+                               np.where( states >= 0, states, np.nan ) ) )
+        if len( names ) > 1:
+            events.append( ( "best_model", "Best Model", decodings.best( names ) ) )
+    return [ ( "abada_event_data", events, store.event_file, store.event_sample ),
+             ( "abada_segment_data", segments, store.segment_file, store.segment_sample ) ]
+
+def export_store( store, fmt=EXPORT_FORMATS[0], split=EXPORT_SPLITS[0], directory=".", excluded=None,
+                  decodings=None ):
+    '''
+    Write out the events and segments of a columnar store. The format is one of
+    EXPORT_FORMATS: CSV files, a compressed .npz archive per table, or a directory
+    per table holding one .npy file per column, which can be opened with
+    np.load( ..., mmap_mode='r' ) to read only the columns needed. The split is one
+    of EXPORT_SPLITS, and writes a separate output for every file or sample. Binary
+    outputs store the file and sample of each row as indices into the filenames and
+    sample_labels arrays stored with them. excluded and decodings are passed on to
+    export_tables.
+    '''
+    for name, columns, files, samples in export_tables( store, excluded, decodings ):
+        if split == "Per File":
+            groups = [ ( safe_name( label ), np.where( files == i )[0] ) 
+                            for i, label in enumerate( store.filenames ) ]
+        elif split == "Per Sample":
+            groups = [ ( safe_name( label ), np.where( samples == i )[0] ) 
+                            for i, label in enumerate( store.sample_labels ) ]
+        else:
+            groups = [ ( None, slice( None ) ) ]
+
+        for suffix, rows in groups:
+            path = os.path.join( directory, name if suffix is None else name + "_" + suffix )
+            table = [ ( key, header, column[ rows ] ) for key, header, column in columns ]
+            if fmt == "CSV":
+                write_csv( path + ".csv", store, table, files[ rows ], samples[ rows ] )
+            else:
+                arrays = OrderedDict( ( key, column ) for key, header, column in table )
+                arrays['file_index'] = files[ rows ]
+                arrays['sample_index'] = samples[ rows ]
+                arrays['filenames'] = np.array( store.filenames )
+                arrays['sample_labels'] = np.array( store.sample_labels )
+                if fmt == "NumPy (.npz)":
+                    np.savez_compressed( path + ".npz", **arrays )
+                else:
+                    if not os.path.isdir( path ):
+                        os.makedirs( path )
+                    for key, array in arrays.items():
+                        np.save( os.path.join( path, key + ".npy" ), array )
+
+def write_csv( path, store, table, files, samples ):
+    '''
+    Write a table to a CSV file in chunks of EXPORT_CHUNK_SIZE rows, formatting each
+    column of a chunk at once. Rows come in runs which share a file and a sample, so
+    those are looked up once per run instead of once per row.
+    '''
+    n = files.shape[0]
+    breaks = np.where( ( np.diff( files ) != 0 ) | ( np.diff( samples ) != 0 ) )[0] + 1
+    starts = np.concatenate( ( [0], breaks ) ).astype( int )
+    ends = np.concatenate( ( breaks, [n] ) ).astype( int )
+
+    with open( path, "w" ) as out:
+        out.write( ",".join( [ "Filename", "Sample" ] + [ header for key, header, column in table ] ) + "\n" )
+        for a, b in zip( starts, ends ):
+            if a == b:
+                continue
+            prefix = "{},{},".format( store.filenames[ files[a] ], store.sample_labels[ samples[a] ] )
+            for k in xrange( a, b, EXPORT_CHUNK_SIZE ):
+                end = min( k + EXPORT_CHUNK_SIZE, b )
+                lines = np.char.mod( "%.12g", table[0][2][ k:end ] )
+                for key, header, column in table[1:]:
+                    lines = np.char.add( np.char.add( lines, "," ), np.char.mod( "%.12g", column[ k:end ] ) )
+                out.write( prefix + ( "\n" + prefix ).join( lines ) + "\n" )
+
+def safe_name( label ):
+    '''
+    Turn a filename or sample label into something usable as part of a filename.
+    '''
+    label = label.split("\\")[-1].split("/")[-1]
+    return "".join( c if c.isalnum() or c in "-_." else "_" for c in label )
+
+SEGMENT_COLORS = [ 'r', 'b', '#FF6600', 'g' ]
+
+def decimate( current, start, timestep, bins ):
+    '''
+    Reduce a trace to the minimum and maximum current over each of about bins equal
+    stretches of time, which draws the same as the full trace when each stretch is
+    narrower than a pixel. Short traces are returned whole. Returns an ( n, 2 ) array
+    of ( time, current ) points.
+    '''
+    n = current.shape[0]
+    if n <= 2 * bins:
+        return np.column_stack( ( start + np.arange( n ) * timestep, current ) )
+    size = int( np.ceil( n / float( bins ) ) )
+    edges = np.arange( 0, n, size )
+    points = np.empty( ( 2 * edges.shape[0], 2 ) )
+    points[0::2, 0] = start + edges * timestep
+    points[1::2, 0] = start + ( edges + size / 2. ) * timestep
+    points[0::2, 1] = np.minimum.reduceat( current, edges )
+    points[1::2, 1] = np.maximum.reduceat( current, edges )
+    return points
+
+def viterbi_states( hmm, means ):
+    '''
+    Return the log probability of the Viterbi path of a HMM through a sequence of
+    segment means, and the index of the hidden state it assigns to each segment, or
+    -inf and None if the HMM has no path through them.
+    '''
+    logp, path = hmm.viterbi( np.array( means ) )
+    states = [ i for i, state in path or [] if not state.is_silent() ]
+    if len( states ) != len( means ):
+        return -np.inf, None
+    return logp, np.array( states, dtype=np.int64 )
+
+def decode_event( hmm, means ):
+    '''
+    Return the Viterbi log probability and hidden states of a sequence of segment
+    means, as viterbi_states does, along with its log-likelihood under the HMM, which
+    is summed over every path by the forward algorithm. The log-likelihood is -inf
+    where the HMM has no path through the means.
+    '''
+    logp, states = viterbi_states( hmm, means )
+    loglik = hmm.log_probability( np.array( means ) ) if states is not None else -np.inf
+    return logp, states, loglik
+
+# HMMs unpickled in this process by decode_events, by model key
+_decode_models = {}
+
+def decode_events( job ):
+    '''
+    Decode a chunk of events with a HMM. This is the unit of work handed to the worker
+    processes. A job is a tuple of ( key, hmm, sequences ), where sequences is a list
+    of ( event index, segment means ), and the result is a list of ( event index,
+    Viterbi log probability, hidden states, log-likelihood ). The HMM may be given
+    pickled, as returned by model_key, in which case it is unpickled once per process
+    and kept by its key.
+    '''
+    key, hmm, sequences = job
+    hmm = job_model( key, hmm )
+    return [ ( i, ) + decode_event( hmm, means ) for i, means in sequences ]
+
+def job_model( key, hmm ):
+    '''
+    Return the HMM of a job, unpickling it if it was given pickled. Only the last
+    few HMMs unpickled are kept, as training hands out a new one every iteration.
+    '''
+    if isinstance( hmm, str ):
+        if key not in _decode_models:
+            if len( _decode_models ) >= 16:
+                _decode_models.clear()
+            _decode_models[ key ] = cPickle.loads( hmm )
+        hmm = _decode_models[ key ]
+    return hmm
+
+TRAINING_ALGORITHMS = [ "Viterbi", "Baum-Welch" ]
+
+def training_counts( job ):
+    '''
+    Accumulate the counts for estimating the emissions of a HMM again over a chunk of
+    events. A job is a tuple of ( key, hmm, algorithm, sequences ), as for
+    decode_events, with the algorithm one of TRAINING_ALGORITHMS. Viterbi training
+    assigns each segment wholly to its state on the Viterbi path, and Baum-Welch
+    spreads it over states by the posterior probability of each. Returns the total
+    log probability of the events, the number of events with a path through the HMM,
+    and for each state the total weight of the segments assigned to it, and the
+    weighted sums of their means and squared means. Events with no path are left out.
+    '''
+    key, hmm, algorithm, sequences = job
+    hmm = job_model( key, hmm )
+    n = len( hmm.states )
+    weights, sums, squares = np.zeros( n ), np.zeros( n ), np.zeros( n )
+    logp, fit = 0., 0
+    for i, means in sequences:
+        means = np.asarray( means, dtype=np.float64 )
+        if algorithm == "Viterbi":
+            event_logp, states = viterbi_states( hmm, means )
+            if states is None:
+                continue
+            weights += np.bincount( states, minlength=n )
+            sums += np.bincount( states, means, minlength=n )
+            squares += np.bincount( states, means ** 2, minlength=n )
+        else:
+            event_logp = hmm.log_probability( means )
+            if not np.isfinite( event_logp ):
+                continue
+            posterior = np.exp( hmm.forward_backward( means )[1] )
+            k = posterior.shape[1]
+            weights[:k] += posterior.sum( axis=0 )
+            sums[:k] += means.dot( posterior )
+            squares[:k] += ( means ** 2 ).dot( posterior )
+        logp += event_logp
+        fit += 1
+    return logp, fit, weights, sums, squares
+
+def emission_positions( hmm, distributions ):
+    '''
+    Return the index into distributions of the distribution emitted by each state of
+    a profile HMM built from them, or -1 for states which emit none of them.
+    '''
+    index = dict( ( id( distribution ), j ) for j, distribution in enumerate( distributions ) )
+    return np.array( [ index.get( id( state.distribution ), -1 ) for state in hmm.states ], 
+                     dtype=np.int64 )
+
+def reestimate( distributions, positions, weights, sums, squares, min_std=TRAINING_MIN_STD ):
+    '''
+    Return the distributions of a profile HMM estimated again from the counts of its
+    states, as given by training_counts. Normal distributions are fit to the weighted
+    mean and standard deviation of the segments assigned to the states emitting them,
+    with the deviation kept above min_std. Other distributions, and those which no
+    segment was assigned to, are kept as they are.
+    '''
+    emitting = positions >= 0
+    n = len( distributions )
+    weights = np.bincount( positions[ emitting ], weights[ emitting ], minlength=n )
+    sums = np.bincount( positions[ emitting ], sums[ emitting ], minlength=n )
+    squares = np.bincount( positions[ emitting ], squares[ emitting ], minlength=n )
+
+    estimated = []
+    for j, distribution in enumerate( distributions ):
+        if distribution.name != "NormalDistribution" or weights[j] <= 0:
+            estimated.append( distribution )
+            continue
+        mean = sums[j] / weights[j]
+        std = np.sqrt( max( squares[j] / weights[j] - mean ** 2, 0. ) )
+        estimated.append( NormalDistribution( mean, max( std, min_std ) ) )
+    return estimated
+
+def structure_key( hmm ):
+    '''
+    Return a key which is the same for baked HMMs with the same states, emissions
+    and transitions, whatever they are named, so that events decoded with one need
+    not be decoded with another. HMMs which do not expose their transitions get
+    None, and are never taken to be the same as another.
+    '''
+    try:
+        edges = [ np.asarray( getattr( hmm, attribute ) ) for attribute in 
+                    ( 'out_edge_count', 'out_transitions', 'out_transition_log_probabilities' ) ]
+        states = [ None if state.is_silent() else 
+                    ( state.distribution.name, repr( state.distribution.parameters ) ) 
+                        for state in hmm.states ]
+        ends = ( hmm.start_index, hmm.end_index )
+    except AttributeError:
+        return None
+    digest = hashlib.sha1( repr( ( states, ends ) ) )
+    for edge in edges:
+        digest.update( edge.tostring() )
+    return digest.hexdigest()
+
+def model_key( hmm ):
+    '''
+    Return a key which is the same for HMMs with the same definition, and the HMM
+    pickled. If it cannot be pickled, the key is only shared by the HMM itself and
+    None is returned in place of the pickle.
+    '''
+    try:
+        data = cPickle.dumps( hmm, cPickle.HIGHEST_PROTOCOL )
+    except Exception:
+        return id( hmm ), None
+    return hashlib.sha1( data ).hexdigest(), data
+
+class DecodeCache( object ):
+    '''
+    Viterbi decodings of the events of an experiment, kept by model name in columns
+    aligned with its event store: whether each event is decoded, the log probability
+    of its Viterbi path, the hidden state of each segment on it, which is -1 where not
+    decoded, and the log-likelihood of the event over every path. Both the event
+    viewer and the analysis window read from it. Safe to use from several threads.
+    '''
+    def __init__( self, store ):
+        self.store = store
+        self.lock = threading.Lock()
+        self.models = OrderedDict()
+
+    def names( self ):
+        with self.lock:
+            return self.models.keys()
+
+    def columns( self, name ):
+        '''
+        Return the ( decoded, Viterbi log probability, segment state, log-likelihood )
+        columns of a model.
+        '''
+        with self.lock:
+            if name not in self.models:
+                self.models[ name ] = ( np.zeros( self.store.n_events, dtype=bool ),
+                                        np.full( self.store.n_events, np.nan ),
+                                        np.full( self.store.n_segments, -1, dtype=np.int64 ),
+                                        np.full( self.store.n_events, np.nan ) )
+            return self.models[ name ]
+
+    def get( self, name, i ):
+        '''
+        Return the log probability and hidden states of event i under a model, or
+        None if it has not been decoded.
+        '''
+        decoded, logp, states, loglik = self.columns( name )
+        if not decoded[i]:
+            return None
+        a, b = self.store.segment_offsets[i], self.store.segment_offsets[i+1]
+        return logp[i], ( states[a:b].copy() if a == b or states[a] >= 0 else None )
+
+    def put( self, name, i, event_logp, event_states, event_loglik ):
+        decoded, logp, states, loglik = self.columns( name )
+        a, b = self.store.segment_offsets[i], self.store.segment_offsets[i+1]
+        logp[i] = event_logp
+        loglik[i] = event_loglik
+        states[a:b] = event_states if event_states is not None else -1
+        decoded[i] = True
+
+    def share( self, source, name ):
+        '''
+        Give a model every decoding of another with the same structure, keeping its
+        own decodings of any other events.
+        '''
+        decoded, logp, states, loglik = self.columns( source )
+        to = self.columns( name )
+        segments = decoded[ self.store.segment_event ]
+        with self.lock:
+            to[0][ decoded ] = True
+            to[1][ decoded ] = logp[ decoded ]
+            to[2][ segments ] = states[ segments ]
+            to[3][ decoded ] = loglik[ decoded ]
+
+    def decode( self, name, hmm, i, means ):
+        '''
+        Return the log probability and hidden states of event i under a model,
+        decoding it if that was not done before.
+        '''
+        found = self.get( name, i )
+        if found is None:
+            self.put( name, i, *decode_event( hmm, means ) )
+            found = self.get( name, i )
+        return found
+
+    def best( self, names ):
+        '''
+        Return the index into names of the model under which each event has the
+        highest log-likelihood, or -1 where no model has a path through it.
+        '''
+        scores = np.array( [ self.columns( name )[3] for name in names ] )
+        scores[ ~np.isfinite( scores ) ] = -np.inf
+        best = np.argmax( scores, axis=0 )
+        best[ ~np.isfinite( scores.max( axis=0 ) ) ] = -1
+        return best
+
+    def invalidate( self, name ):
+        ''' Forget every decoding under a model, such as when it is replaced. '''
+        with self.lock:
+            self.models.pop( name, None )
+
+def state_colors( states, n_states, n_segments, cmap='Set1' ):
+    '''
+    Color segments by the index of their hidden state out of n_states. Segments are
+    black if they have no states.
+    '''
+    if states is None:
+        return [ 'k' ] * n_segments
+    cm = plt.get_cmap( cmap )
+    n = float( max( n_states - 1, 1 ) )
+    return [ cm( i / n ) for i in states ]
+
+class EventTrace( object ):
+    '''
+    The current of an event, split into the stretches drawn in different colors and
+    ready to be drawn at any resolution. In black and white, or if the event has no
+    segments, the whole event is one black stretch. Otherwise each segment is one,
+    colored by the color cycle or by its hidden state in a HMM. The hidden states
+    come from decode, given the segment means, if it is given, and from decoding the
+    event with the HMM otherwise. Times are from the start of the event.
+    '''
+    def __init__( self, event, color='k', hmm=None, decode=None ):
+        current = np.asarray( event.current, dtype=np.float64 )
+        self.duration = event.duration
+        self.timestep = self.duration / max( current.shape[0], 1 )
+        self.ylim = ( current.min(), current.max() ) if current.shape[0] else ( 0., 1. )
+        self.alpha = 1.
+
+        if color == 'k' or event.n == 'N/A' or not event.segments:
+            self.pieces = [ ( 0., current ) ]
+            self.colors = [ 'k' ]
+            return
+
+        self.pieces = [ ( segment.start, np.asarray( segment.current, dtype=np.float64 ) ) 
+                            for segment in event.segments ]
+        if color == 'hmm':
+            means = [ segment.mean for segment in event.segments ]
+            logp, states = decode( means ) if decode is not None else viterbi_states( hmm, means )
+            self.colors = state_colors( states, len( hmm.states ), len( means ) )
+        else:
+            self.colors = [ SEGMENT_COLORS[ i % len( SEGMENT_COLORS ) ] 
+                                for i in xrange( len( self.pieces ) ) ]
+            self.alpha = 0.75
+
+    def lines( self, bins, xlim=None ):
+        '''
+        Return each stretch as an ( n, 2 ) array of ( time, current ) points, decimated
+        so that about bins points pairs are drawn in all. Given xlim, only what falls
+        inside it is kept, so zooming in draws more detail until every sample is drawn.
+        '''
+        spans = []
+        for start, current in self.pieces:
+            a, b = 0, current.shape[0]
+            if xlim is not None:
+                a = min( max( int( np.floor( ( xlim[0] - start ) / self.timestep ) ), 0 ), b )
+                b = min( max( int( np.ceil( ( xlim[1] - start ) / self.timestep ) ) + 1, a ), b )
+            spans.append( ( a, b ) )
+
+        total = float( max( sum( b - a for a, b in spans ), 1 ) )
+        return [ decimate( samples[first:last], offset + first * self.timestep, self.timestep, 
+                           max( int( bins * ( last - first ) / total ), 1 ) )
+                    for ( offset, samples ), ( first, last ) in zip( self.pieces, spans ) ]
+
+def prepare_event( event, color='k', hmm=None, bins=1000, decode=None ):
+    '''
+    Build the trace of an event, and the lines which draw the whole of it across bins
+    pixels, so that drawing it is only a matter of handing the lines to the canvas.
+    '''
+    trace = EventTrace( event, color, hmm, decode )
+    return trace, trace.lines( bins )
+
+class RenderCache( object ):
+    '''
+    Events prepared by prepare_event, kept up to a total of max_size bytes of lines
+    with the least recently used dropped first. The current of an event is shared
+    with the event, so it is not counted. Safe to use from several threads. Every
+    clear() starts a new generation, and events prepared for an earlier generation
+    are not put in, so work which was under way while clearing is not kept.
+    '''
+    def __init__( self, max_size=RENDER_CACHE_SIZE ):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = 0
+
+    def __contains__( self, key ):
+        with self.lock:
+            return key in self.entries
+
+    def get( self, key ):
+        with self.lock:
+            entry = self.entries.pop( key, None )
+            if entry is None:
+                return None
+            self.entries[ key ] = entry
+            return entry[0]
+
+    def put( self, key, prepared, generation=None ):
+        size = sum( line.nbytes for line in prepared[1] )
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            old = self.entries.pop( key, None )
+            if old is not None:
+                self.size -= old[1]
+            self.entries[ key ] = ( prepared, size )
+            self.size += size
+            while self.size > self.max_size and len( self.entries ) > 1:
+                self.size -= self.entries.popitem( last=False )[1][1]
+
+    def clear( self ):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.generation += 1
+
+class Prefetcher( threading.Thread ):
+    '''
+    Prepares events in the background before they are asked for. want() replaces any
+    work still waiting with a new list of ( key, event, color, hmm, bins, decode ), done in
+    order and put into the render cache, skipping keys which are already in it.
+    '''
+    def __init__( self, cache ):
+        super( Prefetcher, self ).__init__()
+        self.daemon = True
+        self.cache = cache
+        self.condition = threading.Condition()
+        self.wanted = []
+
+    def want( self, jobs ):
+        with self.condition:
+            self.wanted = list( jobs )
+            self.condition.notify()
+
+    def run( self ):
+        while True:
+            with self.condition:
+                while not self.wanted:
+                    self.condition.wait()
+                key, event, color, hmm, bins, decode = self.wanted.pop( 0 )
+                generation = self.cache.generation
+            if key in self.cache:
+                continue
+            try:
+                self.cache.put( key, prepare_event( event, color, hmm, bins, decode ), generation )
+            except Exception:
+                pass # The event is prepared again if it is shown, which shows the error
+
+GROUP_COLORS = [ 'r', 'b', 'g', 'm', 'c', 'w', 'k', 'y', '0.25', '0.75' ]
+
+def group_palette( n ):
+    '''
+    Return an ( n, 4 ) array of RGBA colors for n groups, indexed by group code. The
+    first come from GROUP_COLORS, and any past those are spread along a color map.
+    '''
+    colors = [ matplotlib.colors.colorConverter.to_rgba( c ) for c in GROUP_COLORS[:n] ]
+    extra = n - len( colors )
+    cm = plt.get_cmap( 'gist_rainbow' )
+    colors.extend( cm( i / float( extra ) ) for i in xrange( extra ) )
+    return np.array( colors ).reshape( -1, 4 )
+
+def density_counts( x, y, codes, n_groups, xlim, ylim, bins ):
+    '''
+    Count the points of each group which fall in each cell of a grid of bins[0] by
+    bins[1] cells spanning xlim and ylim, in one pass over the points. Returns an
+    array of shape ( n_groups, bins[0], bins[1] ).
+    '''
+    nx, ny = bins
+    inside = ( x >= xlim[0] ) & ( x <= xlim[1] ) & ( y >= ylim[0] ) & ( y <= ylim[1] )
+    ix = ( ( x[ inside ] - xlim[0] ) * ( nx / ( ( xlim[1] - xlim[0] ) or 1. ) ) ).astype( np.int64 )
+    iy = ( ( y[ inside ] - ylim[0] ) * ( ny / ( ( ylim[1] - ylim[0] ) or 1. ) ) ).astype( np.int64 )
+    cells = ( codes[ inside ] * nx + np.minimum( ix, nx - 1 ) ) * ny + np.minimum( iy, ny - 1 )
+    return np.bincount( cells, minlength=n_groups * nx * ny ).reshape( n_groups, nx, ny )
+
+def density_image( counts, palette ):
+    '''
+    Turn the counts of density_counts into an RGBA image for imshow, with rows going
+    up the y axis. Each cell takes the color of the group with the most points in it,
+    and is more opaque the more points it holds, on a log scale.
+    '''
+    total = counts.sum( axis=0 )
+    image = np.array( [ matplotlib.colors.colorConverter.to_rgba( c ) for c in palette ] )
+    image = image[ counts.argmax( axis=0 ) ]
+    image[ ..., 3 ] = np.log1p( total ) / np.log1p( max( total.max(), 1 ) )
+    return image.transpose( 1, 0, 2 )
+
+def state_densities( distribution, grid ):
+    '''
+    Return the density of a distribution at every point of a grid. Normal, uniform
+    and Gaussian kernel densities are computed in closed form over the whole grid at
+    once, and any other distribution one point at a time through log_probability.
+    '''
+    name = getattr( distribution, 'name', None )
+    if name == "NormalDistribution":
+        mean, std = distribution.parameters[:2]
+        return np.exp( -0.5 * ( ( grid - mean ) / std ) ** 2 ) / ( std * np.sqrt( 2 * np.pi ) )
+    elif name == "UniformDistribution":
+        start, end = distribution.parameters[:2]
+        return np.where( ( grid >= start ) & ( grid <= end ), 1. / ( ( end - start ) or 1. ), 0. )
+    elif name == "GaussianKernelDensity":
+        points, bandwidth = np.asarray( distribution.parameters[0], dtype=np.float64 ), distribution.parameters[1]
+        weights = np.asarray( distribution.parameters[2], dtype=np.float64 ) \
+                    if len( distribution.parameters ) > 2 else np.ones( points.shape[0] )
+        weights = weights / weights.sum()
+        density = np.zeros( grid.shape[0] )
+        for point, weight in zip( points, weights ):
+            density += weight * np.exp( -0.5 * ( ( grid - point ) / bandwidth ) ** 2 )
+        return density / ( bandwidth * np.sqrt( 2 * np.pi ) )
+    return np.exp( [ distribution.log_probability( x ) for x in grid ] )
+
+def density_matrix( distributions, grid ):
+    '''
+    Return a states by grid matrix of the density of each distribution at each point
+    of the grid.
+    '''
+    matrix = np.empty( ( len( distributions ), grid.shape[0] ) )
+    for i, distribution in enumerate( distributions ):
+        matrix[i] = state_densities( distribution, grid )
+    return matrix
 
 class Logo( Qt.QLabel ):
     '''
@@ -67,16 +1717,448 @@ class ConfirmWindow( Qt.QWidget ):
         confirmWidget = Qt.QPushButton( "Confirm" )
         quitWidget = Qt.QPushButton( "Quit" )
 
-        grid = Qt.QGridLayout()
-        grid.addWidget( Qt.QLabel( errmsg ), 0, 0, 1, 5 )
-        grid.addWidget( confirmWidget, 2, 4 )
-        grid.addWidget( quitWidget, 2, 5 )
+        grid = Qt.QGridLayout()
+        grid.addWidget( Qt.QLabel( errmsg ), 0, 0, 1, 5 )
+        grid.addWidget( confirmWidget, 2, 4 )
+        grid.addWidget( quitWidget, 2, 5 )
+
+        self.connect( confirmWidget, Qc.SIGNAL( "clicked()" ), function )
+        self.setLayout( grid )
+    def confirm( self ):
+        '''Call the function and exit if the user confirms action.''' 
+        self.function()
+
+def read_query( pool, query, params=() ):
+    ''' Run a query on a pooled connection and return all of its rows. '''
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        # Without parameters MySQLdb leaves the query alone, so literal % survive
+        cursor.execute( query, params or None )
+        rows = cursor.fetchall()
+        cursor.close()
+    return rows
+
+def write_query( pool, query, params=() ):
+    ''' Run a statement on a pooled connection, commit it, and return the rows changed. '''
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        n = cursor.execute( query, params or None )
+        cursor.close()
+    return n
+
+def import_rows( pool, table, columns, rows, batch_size=DATABASE_BATCH_SIZE ):
+    '''
+    Insert rows into the given columns of a table as batches of multi-row inserts, all
+    in one transaction, so that either every row goes in or none do. rows can be any
+    iterable, and is only read one batch at a time. Returns the number of rows.
+    '''
+    statement = insert_statement( table, columns )
+    rows = iter( rows )
+    n = 0
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        for batch in iter( lambda: list( itertools.islice( rows, batch_size ) ), [] ):
+            cursor.executemany( statement, batch )
+            n += len( batch )
+        cursor.close()
+    return n
+
+def delimiter( filename ):
+    ''' Tab for .tsv and .tab files, and comma for anything else. '''
+    return "\t" if filename.lower().endswith( ( ".tsv", ".tab" ) ) else ","
+
+def read_delimited( filename ):
+    '''
+    Open a CSV or TSV file whose first line names its columns. Returns the column
+    names, and an iterator which reads the rows as it is advanced, with empty fields
+    read as NULL.
+    '''
+    infile = open( filename, "rb" )
+    reader = csv.reader( infile, delimiter=delimiter( filename ) )
+    columns = [ column.strip() for column in next( reader, [] ) ]
+    def rows():
+        with infile:
+            for row in reader:
+                if row:
+                    yield [ field if field != "" else None for field in row ]
+    return columns, rows()
+
+def scan_abf( directory, columns ):
+    '''
+    Read the header of every ABF file in a directory. Returns those of the given
+    table columns which match a header field, ignoring case, and an iterator over
+    one row per file. The fields are Filename, without its directory or .abf, Duration
+    in seconds, SampleRate in Hz, Samples and Channels.
+    '''
+    fields = [ "filename", "duration", "samplerate", "samples", "channels" ]
+    matched = [ column for column in columns if column.lower() in fields ]
+    if not any( column.lower() == "filename" for column in matched ):
+        raise ValueError( "The table has no Filename column" )
+    names = sorted( name for name in os.listdir( directory ) if name.lower().endswith( ".abf" ) )
+    def rows():
+        for name in names:
+            reader = ABFReader( os.path.join( directory, name ) )
+            header = { "filename": name[:-4], 
+                       "duration": reader.n / reader.second, "samplerate": reader.second,
+                       "samples": reader.n, "channels": reader.channels }
+            yield [ header[ column.lower() ] for column in matched ]
+    return matched, rows()
+
+def export_query( pool, query, params, columns, filename ):
+    '''
+    Write the rows returned by a query to a CSV, or TSV, file. Rows are streamed from
+    the server a page at a time, so they never all sit in memory. Returns the number
+    of rows written.
+    '''
+    result = QueryResult( pool, query, params, columns )
+    try:
+        result.fetch_count()
+        with open( filename, "wb" ) as outfile:
+            writer = csv.writer( outfile, delimiter=delimiter( filename ) )
+            writer.writerow( result.columns )
+            for row in result.rows():
+                writer.writerow( [ "" if field is None else field for field in row ] )
+    finally:
+        result.close()
+    return result.count
+
+class SchemaCache( object ):
+    '''
+    The names of the tables in the database, and the names and types of the columns
+    of each table. Each is read the first time it is asked for and kept until it is
+    invalidated, so the database viewer does not ask the server again on every search.
+    '''
+    def __init__( self, pool ):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.tables = None
+        self.columns = {}
+
+    def cached( self, table=None ):
+        '''
+        Return the table names, or the ( name, type ) of each column of a table,
+        if they are cached, and None otherwise.
+        '''
+        with self.lock:
+            return self.tables if table is None else self.columns.get( table )
+
+    def load( self, table=None ):
+        ''' Like cached, but reads from the database whatever is not cached. '''
+        schema = self.cached( table )
+        if schema is not None:
+            return schema
+        if table is None:
+            schema = [ row[0] for row in read_query( self.pool, "SHOW TABLES" ) ]
+        else:
+            rows = read_query( self.pool, "SHOW COLUMNS FROM {}".format( table ) )
+            schema = [ ( row[0], row[1] ) for row in rows ]
+        with self.lock:
+            if table is None:
+                self.tables = schema
+            else:
+                self.columns[ table ] = schema
+        return schema
+
+    def invalidate( self, table=None ):
+        ''' Forget the columns of a table, or everything if no table is given. '''
+        with self.lock:
+            if table is None:
+                self.tables = None
+                self.columns.clear()
+            else:
+                self.columns.pop( table, None )
+
+def select_statement( table, columns=None, clauses=() ):
+    '''
+    Build a parameterized SELECT of the given columns, or of all of them, from the rows
+    of a table which meet every ( clause, params ) pair in clauses. Returns the
+    statement and its parameters.
+    '''
+    query = "SELECT {} FROM {}".format( ", ".join( columns ) if columns else "*", table )
+    if clauses:
+        query += " WHERE " + " AND ".join( clause for clause, params in clauses )
+    return query, tuple( p for clause, params in clauses for p in params )
+
+def aliased_statement( query, columns ):
+    '''
+    Rewrite a SELECT so that each table.column it reads is named after itself. Results
+    are counted and paged as a derived table, which may not hold two columns of the
+    same name, as a join of tables sharing a column name would otherwise give.
+    Other columns, such as expressions, are left as they are.
+    '''
+    projection = ", ".join( "{0} AS `{0}`".format( column ) if re.match( r"^\w+\.\w+$", column ) 
+                                else column for column in columns )
+    return "SELECT {} FROM {}".format( projection, query.split( "FROM", 1 )[1].strip() )
+
+class QueryResult( object ):
+    '''
+    The rows returned by a query, read a page at a time. Pages are streamed from a
+    server-side cursor which reads ahead over a window of max_pages pages, so scrolling
+    down a table costs no new query until the window runs out, and jumping elsewhere
+    reopens the cursor at that page. Only the max_pages most recently used pages are
+    kept in memory. The number of rows comes from a COUNT(*) query.
+
+    fetch_count, fetch, rows and close talk to the database and are run by a
+    QueryExecutor, while cached and store are only used from the GUI thread.
+    '''
+    def __init__( self, pool, query, params, columns, page_size=DATABASE_PAGE_SIZE, 
+                  max_pages=DATABASE_CACHED_PAGES ):
+        self.pool = pool
+        self.params = tuple( params )
+        # Without parameters MySQLdb leaves the query alone, so literal % are not escaped
+        self.query = query if self.params else query.replace( "%", "%%" )
+        self.columns = list( columns )
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.pages = OrderedDict()
+        self.count = 0
+        self.conn = None
+        self.thread_id = None
+        self.cursor = None
+        self.position = None
+        self.window_end = None
+
+    def fetch_count( self ):
+        ''' Count the rows returned by the query. '''
+        self._close_cursor()
+        cursor = self._connect().cursor()
+        cursor.execute( "SELECT COUNT(*) FROM ( {} ) AS counted".format( self.query ), self.params )
+        self.count = int( cursor.fetchone()[0] )
+        cursor.close()
+        return self.count
+
+    def cached( self, p ):
+        ''' Return page p if it is in memory, and None otherwise. '''
+        if p not in self.pages:
+            return None
+        self.pages[p] = self.pages.pop( p )
+        return self.pages[p]
+
+    def store( self, p, rows ):
+        ''' Keep a page in memory, evicting the least recently used page if needed. '''
+        self.pages[p] = rows
+        while len( self.pages ) > self.max_pages:
+            self.pages.popitem( last=False )
+
+    def fetch( self, p ):
+        ''' Read page p from the server-side cursor. '''
+        if self.cursor is None or self.position != p or p >= self.window_end:
+            self._open( p )
+        rows = self.cursor.fetchmany( self.page_size )
+        self.position = p + 1
+        return list( rows )
+
+    def rows( self ):
+        ''' Iterate over every row, without keeping them all in memory. '''
+        for p in xrange( ( self.count + self.page_size - 1 ) // self.page_size ):
+            for row in self.fetch( p ):
+                yield row
+
+    def kill( self ):
+        ''' Stop the query this result is running, from another connection. '''
+        thread_id = self.thread_id
+        if thread_id is not None:
+            write_query( self.pool, "KILL QUERY %s", ( thread_id, ) )
+
+    def close( self ):
+        ''' Close the cursor, and give the connection back to the pool. '''
+        self._close_cursor()
+        if self.conn is not None:
+            self.pool.release( self.conn )
+            self.conn, self.thread_id = None, None
+
+    def __del__( self ):
+        # Windows are deleted without warning, so hand the connection back here too
+        self.close()
+
+    def _connect( self ):
+        if self.conn is None:
+            self.conn = self.pool.acquire()
+            self.thread_id = self.conn.thread_id()
+        return self.conn
+
+    def _open( self, p ):
+        self._close_cursor()
+        self.cursor = self._connect().cursor( MySQLdb.cursors.SSCursor )
+        self.cursor.execute( "SELECT * FROM ( {} ) AS paged LIMIT %s, %s".format( self.query ),
+                             self.params + ( p * self.page_size, self.max_pages * self.page_size ) )
+        self.position, self.window_end = p, p + self.max_pages
+
+    def _close_cursor( self ):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+
+class ResultCache( object ):
+    '''
+    The most recently shown query results, with their row counts and whatever pages
+    they have in memory, so that showing one again costs no query. Results are keyed
+    by the tables they read from and their statement. A result is handed to close
+    when it is pushed out of the cache or invalidated, and when release is called, so
+    that results which are not shown do not hold on to a connection.
+    '''
+    def __init__( self, close, size=DATABASE_CACHED_RESULTS ):
+        self.close = close
+        self.size = size
+        self.results = OrderedDict()
+
+    def get( self, key ):
+        result = self.results.pop( key, None )
+        if result is not None:
+            self.results[ key ] = result
+        return result
+
+    def put( self, key, result ):
+        self.results.pop( key, None )
+        self.results[ key ] = result
+        while len( self.results ) > self.size:
+            self.close( self.results.popitem( last=False )[1] )
+
+    def invalidate( self, table=None ):
+        ''' Drop every result read from a table, or every result if no table is given. '''
+        for key in [ key for key in self.results if table is None or table in key[0] ]:
+            self.close( self.results.pop( key ) )
+
+    def release( self ):
+        ''' Close every result, keeping them in the cache. '''
+        for result in self.results.values():
+            self.close( result )
+
+class QueryExecutor( Qc.QThread ):
+    '''
+    Runs database work one job at a time in a background thread, so a slow query
+    never blocks the GUI. Each job is handed to its callback in the GUI thread along
+    with the number of seconds it took, or to its errback if it raised. cancel()
+    drops every cancellable job submitted before it, ignoring their results, and
+    kills the query of the one running if it was given a way to.
+    '''
+    done = Qc.pyqtSignal( int, object, object, float )
+
+    def __init__( self, parent=None ):
+        super( QueryExecutor, self ).__init__( parent )
+        self.jobs = Queue.Queue()
+        self.callbacks = {}
+        self.tickets = itertools.count()
+        self.generation = 0
+        self.running = None
+        self.done.connect( self._dispatch )
+
+    def submit( self, function, args=(), callback=None, errback=None, kill=None, cancellable=True,
+                always=None ):
+        '''
+        Queue function( *args ) and return its ticket. Jobs which change the database
+        should not be cancellable, so that they are never dropped. always is called
+        once the job is over, whether it succeeded, failed or was cancelled.
+        '''
+        ticket = next( self.tickets )
+        generation = self.generation if cancellable else None
+        self.callbacks[ ticket ] = ( callback, errback, generation, always )
+        self.jobs.put( ( ticket, generation, function, args, kill ) )
+        return ticket
+
+    def cancel( self ):
+        ''' Drop every cancellable job, stopping the one running if possible. '''
+        self.generation += 1
+        running = self.running
+        if running is not None and running[1] is not None and running[4] is not None:
+            # Killing needs a query of its own, so keep it off the GUI thread too
+            threading.Thread( target=self._kill, args=( running[4], ) ).start()
+
+    def stop( self ):
+        ''' Cancel what is left and wait for the thread to end. '''
+        self.cancel()
+        self.jobs.put( None )
+        self.wait()
+
+    def run( self ):
+        for job in iter( self.jobs.get, None ):
+            ticket, generation, function, args, kill = job
+            if generation is not None and generation != self.generation:
+                self.done.emit( ticket, None, None, 0.0 )
+                continue
+            self.running = job
+            start = time.time()
+            try:
+                value, error = function( *args ), None
+            except Exception as e:
+                value, error = None, e
+            self.running = None
+            self.done.emit( ticket, value, error, time.time() - start )
+
+    def _kill( self, kill ):
+        try:
+            kill()
+        except MySQLdb.Error:
+            pass # The query has already finished
 
-        self.connect( confirmWidget, Qc.SIGNAL( "clicked()" ), function )
-        self.setLayout( grid )
-    def confirm( self ):
-        '''Call the function and exit if the user confirms action.''' 
-        self.function()
+    def _dispatch( self, ticket, value, error, seconds ):
+        callback, errback, generation, always = self.callbacks.pop( ticket )
+        try:
+            if always is not None:
+                always()
+            if generation is not None and generation != self.generation:
+                return
+            if error is None:
+                if callback is not None:
+                    callback( value, seconds )
+            elif errback is not None:
+                errback( error, seconds )
+        except RuntimeError:
+            pass # The window which asked for it has been closed since
+
+class DatabaseTableModel( Qc.QAbstractTableModel ):
+    '''
+    A table model which shows a QueryResult. Pages which are not in memory are
+    fetched by a QueryExecutor as the view scrolls over them, and fill in the
+    table as they arrive.
+    '''
+    def __init__( self, result, executor, errback=None, parent=None ):
+        super( DatabaseTableModel, self ).__init__( parent )
+        self.result = result
+        self.executor = executor
+        self.errback = errback
+        self.requested = set()
+
+    def rowCount( self, parent=Qc.QModelIndex() ):
+        return 0 if parent.isValid() else self.result.count
+
+    def columnCount( self, parent=Qc.QModelIndex() ):
+        return 0 if parent.isValid() else len( self.result.columns )
+
+    def data( self, index, role=Qc.Qt.DisplayRole ):
+        if not index.isValid() or role != Qc.Qt.DisplayRole:
+            return Qc.QVariant()
+        p, i = divmod( index.row(), self.result.page_size )
+        rows = self.result.cached( p )
+        if rows is None:
+            self._request( p )
+            return Qc.QVariant( "..." )
+        if i >= len( rows ): # The table shrank after it was counted
+            return Qc.QVariant()
+        return Qc.QVariant( unicode( rows[i][ index.column() ] ) )
+
+    def headerData( self, section, orientation, role=Qc.Qt.DisplayRole ):
+        if role != Qc.Qt.DisplayRole:
+            return Qc.QVariant()
+        if orientation == Qc.Qt.Horizontal:
+            return Qc.QVariant( self.result.columns[ section ] )
+        return Qc.QVariant( section + 1 )
+
+    def _request( self, p ):
+        if p not in self.requested:
+            self.requested.add( p )
+            self.executor.submit( self.result.fetch, ( p, ), 
+                                  lambda rows, seconds: self._arrived( p, rows ),
+                                  self.errback, self.result.kill,
+                                  always=lambda: self.requested.discard( p ) )
+
+    def _arrived( self, p, rows ):
+        self.result.store( p, rows )
+        first = p * self.result.page_size
+        last = min( first + len( rows ), self.result.count ) - 1
+        if last >= first:
+            self.dataChanged.emit( self.index( first, 0 ), 
+                                   self.index( last, self.columnCount() - 1 ) )
 
 class ChenooViewer( Qt.QWidget ):
     '''
@@ -86,43 +2168,117 @@ class ChenooViewer( Qt.QWidget ):
     made from querying the columns in the table. Add, search, and delete are functions on
     all tables, while save files is a property on the table specified in config.py under
     SOURCE.
+
+    Every query is run by the query executor on the main page, and anything still
+    running is cancelled when another table is picked or a new search is started.
+    Table and column names come from the schema cache on the main page, and recent
+    results from its result cache, both of which Refresh empties. Only the columns
+    listed in the projection line are shown, or all of them if it is left blank.
+    Rows can be imported in bulk from a CSV or TSV file, or from the headers of a
+    directory of ABF files, and whatever is shown can be exported to a file.
     '''
     def __init__( self, parent ):
         super( ChenooViewer, self ).__init__( parent )
         self.parent = parent
-        self.db = MySQLDatabaseInterface( db=DATABASE, host=DATABASE_HOST, 
-                                          password=DATABASE_PASSWORD, user=DATABASE_USER )
-        self.tableView = Qt.QTableWidget()
+        self.executor = parent.query_executor
+        self.schema = parent.schema
+        self.results = parent.query_results
+        self.results.release() # An earlier viewer may have left one open
+        self.executor.cancel() # Nothing asked for by an earlier viewer is needed now
+        self.tableView = Qt.QTableView()
+        self.result = None
+        self.shown = None
+        self.table = None
+        self.columns = []
+        self.column_types = []
+        self.column_inputs = {}
         self.tableSelector = Qt.QComboBox()
         self.tableSelector.activated[ str ].connect( self._update )
-        for table in self.db.read( "SHOW TABLES" ):
-            self.tableSelector.addItem( table[0] )
 
         addButton = Qt.QPushButton( "Add" )
         searchButton = Qt.QPushButton( "Search" )
         deleteButton = Qt.QPushButton( "Delete" )
         queryButton = Qt.QPushButton( "SQL Query" )
+        refreshButton = Qt.QPushButton( "Refresh" )
+        importButton = Qt.QPushButton( "Import File" )
+        scanButton = Qt.QPushButton( "Import ABFs" )
+        exportButton = Qt.QPushButton( "Export" )
 
         self.connect( addButton, Qc.SIGNAL("clicked()"), self._add )
         self.connect( searchButton, Qc.SIGNAL("clicked()"), self._search )
         self.connect( deleteButton, Qc.SIGNAL("clicked()"), self._delete_confirm )
         self.connect( queryButton, Qc.SIGNAL("clicked()"), self._build_view )
+        self.connect( refreshButton, Qc.SIGNAL("clicked()"), self._refresh )
+        self.connect( importButton, Qc.SIGNAL("clicked()"), self._import_file )
+        self.connect( scanButton, Qc.SIGNAL("clicked()"), self._import_abf )
+        self.connect( exportButton, Qc.SIGNAL("clicked()"), self._export )
 
         self.inputGrid = Qt.QGridLayout()
         self.grid = Qt.QGridLayout()
         self.grid.setVerticalSpacing(0)
         self.grid.addWidget( self.tableSelector, 0, 0 )
+        self.grid.addWidget( refreshButton, 0, 11 )
         self.grid.addWidget( self.tableView, 1, 0, 10, 12 )
+        self.projection_input = Qt.QLineEdit()
+        self.grid.addWidget( Qt.QLabel( "Columns" ), 11, 0 )
+        self.grid.addWidget( self.projection_input, 11, 1, 1, 11 )
         self.grid.addLayout( self.inputGrid, 12, 0, 4, 10 )
         self.grid.addWidget( addButton, 12, 11 )
         self.grid.addWidget( searchButton, 13, 11 )
         self.grid.addWidget( deleteButton, 14, 11)
+        self.grid.addWidget( importButton, 12, 10 )
+        self.grid.addWidget( scanButton, 13, 10 )
+        self.grid.addWidget( exportButton, 14, 10 )
         self.query_input = Qt.QLineEdit()
         self.grid.addWidget( Divider(), 16, 0, 1, 12 )
         self.grid.addWidget( queryButton, 17, 11 )
         self.grid.addWidget( self.query_input, 17, 0, 1, 11 )
+        self.statusLabel = Qt.QLabel( "" )
+        self.grid.addWidget( self.statusLabel, 18, 0, 1, 12 )
 
         self.setLayout( self.grid )
+        self._schema( None, self._tables_listed )
+
+    def _run( self, action, function, args=(), callback=None, kill=None, cancellable=True ):
+        '''
+        Submit a job to the executor, showing what is running in the status area
+        and how long it took once it is done.
+        '''
+        self.statusLabel.setText( "{}...".format( action ) )
+        def finished( value, seconds ):
+            self.statusLabel.setText( "{} took {:.3f} s".format( action, seconds ) )
+            if callback is not None:
+                callback( value )
+        return self.executor.submit( function, args, finished, self._failed, kill, cancellable )
+
+    def _failed( self, error, seconds ):
+        self.statusLabel.setText( "Query failed after {:.3f} s: {}".format( seconds, error ) )
+
+    def _schema( self, table, callback ):
+        '''
+        Hand callback the table names, or the columns of a table, reading them from
+        the database only if they are not in the schema cache.
+        '''
+        schema = self.schema.cached( table )
+        if schema is not None:
+            callback( schema )
+        else:
+            action = "Listing tables" if table is None else "Reading columns"
+            self._run( action, self.schema.load, ( table, ), callback )
+
+    def _refresh( self ):
+        ''' Forget the cached schema, and read it again from the database. '''
+        self.executor.cancel()
+        self.schema.invalidate()
+        self.results.invalidate()
+        self.tableSelector.clear()
+        self._schema( None, self._tables_listed )
+
+    def _tables_listed( self, tables ):
+        for table in tables:
+            self.tableSelector.addItem( table )
+        if self.table in tables:
+            self.tableSelector.setCurrentIndex( tables.index( self.table ) )
         self._update()
 
     def _update( self ):
@@ -131,8 +2287,9 @@ class ChenooViewer( Qt.QWidget ):
         search from the current parameters-- either of the specified table by using
         the menu, or across an arbitrary number of tables with the SQL Query line.
         '''
+        self.executor.cancel()
         for i in range( self.inputGrid.count() ): self.inputGrid.itemAt(i).widget().close()
-        self.table = self.tableSelector.currentText()
+        self.table = str( self.tableSelector.currentText() )
         if self.table == DATABASE_SOURCE:
             self.saveButton = Qt.QPushButton( "Save Files" )
             self.connect( self.saveButton, Qc.SIGNAL("clicked()"), self._save_files )
@@ -143,7 +2300,11 @@ class ChenooViewer( Qt.QWidget ):
             except:
                 pass
 
-        self.columns = [ column[0] for column in self.db.read( "SHOW COLUMNS IN {}".format( self.table ))]
+        self._schema( self.table, self._columns_listed )
+
+    def _columns_listed( self, column_types ):
+        self.column_types = column_types
+        self.columns = [ column for column, column_type in self.column_types ]
         self.column_inputs = { column: Qt.QLineEdit() for column in self.columns }
         self._search()
         self.inputGrid.setVerticalSpacing(0)
@@ -161,103 +2322,680 @@ class ChenooViewer( Qt.QWidget ):
 
     def _search( self ):
         '''
-        Gets the results of a query and updates the table widget with those
-        results. 
+        Gets the results of a query and updates the table view with those
+        results. Only the row count is fetched here, and rows are fetched a
+        page at a time as the view scrolls over them.
         '''
-        results = self._query_database()
-        self.tableView.clear()
-        self.tableView.setRowCount( MAX_DATABASE_SIZE )
-        self.tableView.setColumnCount( len( self.columns ) )
-        self.tableView.setHorizontalHeaderLabels( self.columns )
-        i = 0
-        for i in xrange( len( results ) ):
-            for j in xrange( len( self.columns ) ):
-                try:
-                    cell = Qt.QTableWidgetItem( unicode( results[i][j] ) )
-                    self.tableView.setItem( i, j, cell )
-                except:
-                    pass
-        self.tableView.setRowCount( i+1 )
-        self.tableView.setColumnCount( len( self.columns ) )
+        projection = self._get_projection()
+        if projection is None:
+            return
+        query, params = self._build_query( projection )
+        self._show( ( self.table, ), query, params, projection or self.columns )
+
+    def _show( self, tables, query, params, columns ):
+        '''
+        Show the results of a query in the table view. A result in the result cache is
+        shown straight away, and any other once its rows are counted.
+        '''
+        self.executor.cancel()
+        if self.result is not None:
+            # The executor may still be reading from it, so close it there
+            self.executor.submit( self.result.close, cancellable=False )
+        self.shown = ( query, params, columns )
+        key = ( tuple( tables ), tuple( columns ), query, tuple( params ) )
+        self.result = result = self.results.get( key )
+        if result is not None:
+            self.statusLabel.setText( "{} rows from the result cache".format( result.count ) )
+            self._set_model( result )
+            return
+        self.result = result = QueryResult( self.parent.db_pool, query, params, columns )
+        self._run( "Counting rows", result.fetch_count, (), 
+                   lambda n: self._counted( key, result ), result.kill )
+
+    def _counted( self, key, result ):
+        self.results.put( key, result )
+        self._set_model( result )
+
+    def _set_model( self, result ):
+        self.tableView.setModel( DatabaseTableModel( result, self.executor, self._failed, self ) )
 
     def _get_input( self ):
         return ( self.column_inputs[ column ].text() or None for column in self.columns ) 
 
+    def _get_projection( self ):
+        '''
+        Return the columns typed into the projection line, or an empty list if it is
+        blank. Returns None if a column is not in the table.
+        '''
+        projection = [ column.strip() for column in str( self.projection_input.text() ).split(",") ]
+        projection = [ column for column in projection if column ]
+        unknown = [ column for column in projection if column not in self.columns ]
+        if unknown:
+            self.statusLabel.setText( "No column {} in {}".format( ", ".join( unknown ), self.table ) )
+            return None
+        return projection
+
     def _add( self ):
         '''
-        Take the entry from _get_input() and build an Entry object which can be
-        committed to the database. NOTE: May change to have attribute-secure Entry
-        with no NanoEntry. 
+        Take the entry from _get_input() and insert it as a new row of the table,
+        showing the table again once it is in.
         '''
-        self.db.insert( self.table, self._get_input() )
+        values = [ None if entry is None else str( entry ) for entry in self._get_input() ]
+        self._run( "Adding row", write_query, 
+                   ( self.parent.db_pool, insert_statement( self.table, self.columns ), values ),
+                   lambda n: self._changed(), cancellable=False )
 
-    def _build_clauses( self ):
+    def _import_file( self ):
+        '''
+        Insert every row of a CSV or TSV file into the table, in one transaction. The
+        first line of the file names the columns its fields go into.
+        '''
+        filename = str( Qt.QFileDialog.getOpenFileName( self, "Import Rows", "", 
+                                                        "Tables (*.csv *.tsv *.tab *.txt)" ) )
+        if not filename:
+            return
+        columns, rows = read_delimited( filename )
+        unknown = [ column for column in columns if column not in self.columns ]
+        if unknown or not columns:
+            self.statusLabel.setText( "No column {} in {}".format( ", ".join( unknown ), self.table ) )
+            return
+        self._run( "Importing rows", import_rows, ( self.parent.db_pool, self.table, columns, rows ),
+                   lambda n: self._changed(), cancellable=False )
+
+    def _import_abf( self ):
         '''
-        Builds a SQL query from user input, and returns that query. Currently all columns are returned
-        for rows which are selected. No support is provided for projections yet. 
+        Insert a row for every ABF file in a directory, in one transaction, filling in
+        whichever of the table's columns match a field of the file headers.
         '''
-        column_data = self.db.read( "SHOW COLUMNS FROM {}".format(self.table) )
-        columns = [ column[0] for column in column_data ]
-        column_types = [ column[1] for column in column_data ] 
+        directory = str( Qt.QFileDialog.getExistingDirectory( self, "Import ABF Files" ) )
+        if not directory:
+            return
+        def scan( pool, table, columns, directory ):
+            return import_rows( pool, table, *scan_abf( directory, columns ) )
+        self._run( "Importing files", scan, ( self.parent.db_pool, self.table, self.columns, directory ),
+                   lambda n: self._changed(), cancellable=False )
+
+    def _export( self ):
+        ''' Write every row of the shown result to a CSV or TSV file. '''
+        if self.shown is None:
+            return
+        filename = str( Qt.QFileDialog.getSaveFileName( self, "Export Rows", "", 
+                                                        "CSV (*.csv);;TSV (*.tsv)" ) )
+        if not filename:
+            return
+        query, params, columns = self.shown
+        self._run( "Exporting rows", export_query, 
+                   ( self.parent.db_pool, query, params, columns, filename ) )
+
+    def _changed( self ):
+        ''' Show the table again after rows were added or deleted. '''
+        self.schema.invalidate( self.table )
+        self.results.invalidate( self.table )
+        self._search()
 
+    def _build_clauses( self ):
+        '''
+        Builds the clauses of a search from user input, as a list of ( clause, params )
+        pairs. The input only ever goes into the parameters, so statements are the same
+        from one search to the next and nothing typed in is run as SQL.
+        '''
         entries = self._get_input()
         clauses = []
-        for column, column_type, entry in zip( columns, column_types, entries ):
+        for ( column, column_type ), entry in zip( self.column_types, entries ):
             if entry == None: # If nothing was entered into the field
                 continue      # then do nothing 
-            entry = entry.replace(" ", "") # Remove any extra white space that may be there
+            entry = str( entry ).replace(" ", "") # Remove any extra white space that may be there
+            if entry == "": 
+                continue
             if entry == "None": # If the entry is None, they're looking for empty cells
-                clauses.append( "{column} IS NULL".format( column=column ) ) # Look where cell is null
-            if 'varchar' in column_type: # If the cell type is a varchar
+                clauses.append( ( "{column} IS NULL".format( column=column ), () ) ) # Look where cell is null
+            elif 'varchar' in column_type: # If the cell type is a varchar
                 if entry[-1] != '*':     # and they're looking for a wildcard, append the wildcard
-                    clauses.append( "{column} = '{entry}'".format( column=column, entry=entry ) )
+                    clauses.append( ( "{column} = %s".format( column=column ), ( entry, ) ) )
                 else:
-                    clauses.append( "{column} LIKE '%{entry}%'".format( column=column, 
-                                                                        entry=entry[:-1] ) )
+                    clauses.append( ( "{column} LIKE %s".format( column=column ), 
+                                      ( "%{}%".format( entry[:-1] ), ) ) )
             elif 'float' in column_type or 'int' in column_type:
-                clauses.append( "{column} = {entry}".format( column=column, entry=entry ) )
+                clauses.append( ( "{column} = %s".format( column=column ), ( entry, ) ) )
 
-        return ' AND '.join( clauses ) or None 
+        return clauses
 
     def _build_view( self ):
         query = str( self.query_input.text() )
         assert 'DROP' not in query.upper() and 'DELETE' not in query.upper() 
-        self.columns = query.strip().split( "SELECT" )[1].split( "FROM" )[0].strip().split(",")
-        self.tables = query.strip().split("FROM")[1].split("WHERE")[0].strip().split(",")
-        if self.columns == ['*']:
-            column_data = [ [ table+"."+column[0] for column 
-                                in self.db.read( "SHOW COLUMNS FROM {}".format(table) ) ] 
-                                for table in self.tables ]
-            self.columns = np.concatenate( column_data )
-
-    def _query_database( self ):
-        clauses = self._build_clauses()
-        if clauses:
-            query = "SELECT * FROM {table} WHERE {clauses}".format( clauses=clauses, table=self.table )
+        columns = query.strip().split( "SELECT" )[1].split( "FROM" )[0].strip().split(",")
+        self.tables = [ table.strip() for table in 
+                            query.strip().split("FROM")[1].split("WHERE")[0].strip().split(",") ]
+        if columns == ['*']:
+            self._run( "Reading columns", self._view_columns, ( self.tables, ), 
+                       lambda columns: self._show( self.tables, aliased_statement( query, columns ), 
+                                                   (), columns ) )
         else:
-            query = "SELECT * FROM {table}".format( table=self.table )
-        return self.db.read( query )
+            columns = [ column.strip() for column in columns ]
+            self._show( self.tables, aliased_statement( query, columns ), (), columns )
+
+    def _view_columns( self, tables ):
+        return [ table+"."+column for table in tables 
+                    for column, column_type in self.schema.load( table ) ]
+
+    def _build_query( self, projection=None ):
+        return select_statement( self.table, projection, self._build_clauses() )
 
     def _delete_confirm( self ):
-        n = len( self._query_database() )
+        clauses = self._build_clauses()
+        if not clauses:
+            self.statusLabel.setText( "Fill in which rows to delete first" )
+            return
+        query, params = select_statement( self.table, [ "COUNT(*)" ], clauses )
+        self._run( "Counting rows", read_query, ( self.parent.db_pool, query, params ),
+                   lambda rows: self._confirm( int( rows[0][0] ), clauses ) )
+
+    def _confirm( self, n, clauses ):
         errmsg = "Do you really want to delete {0} entr{1}?".format(n, ['y', 'ies'][n>1] )
-        self.confirmWindow = ConfirmWindow( self, errmsg, self._delete )
+        self.confirmWindow = ConfirmWindow( self, errmsg, lambda: self._delete( clauses ) )
         self.confirmWindow.show()
 
-    def _delete( self ):
+    def _delete( self, clauses ):
         del self.confirmWindow
         query = "DELETE FROM {table} WHERE {clauses}".format( table=self.table, 
-                                                              clauses=self._build_clauses() )
-        self.db.delete( query=query )
+                    clauses=" AND ".join( clause for clause, params in clauses ) )
+        params = tuple( p for clause, params in clauses for p in params )
+        self._run( "Deleting rows", write_query, ( self.parent.db_pool, query, params ),
+                   lambda n: self._changed(), cancellable=False )
     
     def _save_files( self ):
+        query, params = self._build_query( [ self.columns[0], self.columns[3] ] )
+        self._run( "Reading files", read_query, ( self.parent.db_pool, query, params ), 
+                   self._files_read )
+
+    def _files_read( self, rows ):
         files = []
-        for i in range( self.tableView.rowCount() ):
-            filename = str( self.tableView.item( i, 0 ).text() )
-            station = str( self.tableView.item( i, 3 ).text() )
+        for row in rows:
+            filename, station = str( row[0] ), str( row[1] )
             files.append( "{filename}-s0{station}".format( filename=filename, station=station ) )
         self.parent.saved_files = files
 
+class AnalysisWorker( Qc.QThread ):
+    '''
+    Runs the detection and segmentation pipeline in a background thread, so that the
+    Qt event loop never waits on it. Progress, finished files and errors are sent back
+    through signals. Every setting is read in before the thread starts, because widgets
+    may only be touched from the GUI thread. When the thread finishes, the analyzed
+    files are sent out as a new experiment, which the main page takes up in the GUI
+    thread, so the windows reading the current experiment never see it change.
+    '''
+    progress = Qc.pyqtSignal( float, int )
+    fileDone = Qc.pyqtSignal( int, object )
+    error = Qc.pyqtSignal( int, object )
+    status = Qc.pyqtSignal( object )
+    analyzed = Qc.pyqtSignal( object )
+
+    def __init__( self, parent, filenames, sample_names, event_detector, segmenter, 
+                  order, cutoff, options, cache=None ):
+        super( AnalysisWorker, self ).__init__( parent )
+        self.parent = parent
+        self.cache = cache
+        self.filenames = filenames
+        self.sample_names = sample_names
+        self.event_detector = event_detector
+        self.segmenter = segmenter
+        self.order = order
+        self.cutoff = cutoff
+        self.options = options
+        self.active = True
+        self.pool = None
+        self.files = [ None for filename in filenames ]
+        self.keys = [ None for filename in filenames ]
+        self.metadata = ( event_detector.__class__.__name__, repr( event_detector ),
+                          segmenter.__class__.__name__, repr( segmenter ), cutoff, order )
+        self.stored = {}
+        self.batched = True # Whether the database can be read and written in batches
+        self.writer = None
+        self.n_events = 0
+        self.start_time = time.time()
+        self.last_emit = 0
+
+    def stop( self ):
+        '''Stop after the current event, dropping any files still queued.'''
+        self.active = False
+        if self.pool is not None:
+            self.pool.cancel()
+
+    def run( self ):
+        # Allow files to be cached even though these parsers hold on to their widgets
+        for parser in ( self.event_detector, self.segmenter ):
+            copy_reg.pickle( parser.__class__, reduce_parser )
+
+        # Create a mapping between the name of the sample, and the sample object
+        self.smap = { name: Sample( label=name ) for name in set( self.sample_names ) }
+
+        if self.options['load_database'] or self.options['save_database']:
+            try:
+                self.batched = analysis_tables_match( self.parent.db_pool )
+            except Exception as e:
+                self.status.emit( "Could not read the layout of the analysis tables: {}".format( e ) )
+            if not self.batched:
+                self.status.emit( "The analysis tables are not laid out as expected, so files "
+                                  "are loaded and saved one at a time" )
+
+        if self.options['load_database'] and self.batched:
+            self._prefetch()
+
+        if self.options['save_database']:
+            self.writer = DatabaseWriter( self.parent.db_pool, self.metadata, self.error.emit,
+                                          self.batched )
+            self.writer.start()
+
+        try:
+            if self.options['workers'] > 1:
+                self._run_parallel()
+            else:
+                self._run_serial()
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+
+        # Nothing else sees the new experiment until it is sent, so build its store here
+        experiment = Experiment( filenames=[] )
+        experiment.files = [ file for file in self.files if file is not None ]
+        experiment.store = EventStore( experiment )
+        self.analyzed.emit( experiment )
+
+    def _emit_progress( self, fraction, force=False ):
+        '''
+        Send the progress out at most once every PROGRESS_INTERVAL seconds, unless
+        forced, so that the GUI thread is not flooded with updates.
+        '''
+        now = time.time()
+        if force or now - self.last_emit >= PROGRESS_INTERVAL:
+            self.last_emit = now
+            self.progress.emit( fraction, self.n_events )
+
+    def _load( self, i, filename ):
+        '''
+        Try to load a previous analysis of the file, first from the analysis cache and
+        then from either the database or a JSON file, depending on which options are
+        checked. Returns None if no previous analysis could be loaded.
+        '''
+        if self._key( i, filename ) is not None:
+            file = self.cache.get( self.keys[i] )
+            if file is not None:
+                return file
+
+        file = self._load_stored( filename )
+        if file is not None:
+            self._cache( i, file )
+        return file
+
+    def _key( self, i, filename ):
+        '''
+        Return the analysis cache key of a file, or None if it cannot be cached.
+        '''
+        if self.cache is not None and self.keys[i] is None:
+            try:
+                self.keys[i] = self.cache.key( filename+".abf", self.event_detector, 
+                                               self.segmenter, self.order, self.cutoff,
+                                               self.options['chunk_size'] )
+            except ( IOError, OSError ):
+                pass
+        return self.keys[i]
+
+    def _prefetch( self ):
+        '''
+        Fetch the stored analyses of every file which is not in the analysis cache in
+        a handful of batched queries, before any file is analyzed. Only the files with
+        no stored analysis are then parsed.
+        '''
+        names = {}
+        for i, filename in enumerate( self.filenames ):
+            key = self._key( i, filename )
+            if key is None or key not in self.cache:
+                names[ filename.split("\\")[-1] ] = filename
+
+        start = time.time()
+        try:
+            self.stored = load_analyses( self.parent.db_pool, names.keys(), self.metadata )
+        except Exception as e:
+            self.status.emit( "Could not load analyses from the database: {}".format( e ) )
+        else:
+            self.status.emit( "Loaded {} of {} analyses from the database in {:.2f}s".format(
+                                len( self.stored ), len( names ), time.time() - start ) )
+
+    def _load_stored( self, filename ):
+        '''
+        Try to load a previous analysis of the file from either the analyses fetched
+        from the database or a JSON file, depending on which options are checked.
+        Returns None if no previous analysis could be loaded.
+        '''
+        try:
+            if self.options['load_database'] and not self.batched:
+                return File.from_database( filename=filename.split("\\")[-1], 
+                                           **database_options( self.metadata ) )
+            elif self.options['load_database']:
+                rows = self.stored.pop( filename.split("\\")[-1], None )
+                if rows is not None:
+                    return build_file( filename, rows[0], rows[1], self.order, self.cutoff )
+            elif self.options['load_json']:
+                if filename.endswith( "json" ):
+                    return File.from_json( filename )
+                else:
+                    return File.from_json( filename+".json" )
+        except Exception:
+            pass
+        return None
+
+    def _cache( self, i, file ):
+        '''
+        Store a newly analyzed file to the analysis cache. This must happen before
+        the events are attached to their sample, so the sample is not stored too.
+        '''
+        if self.cache is not None and self.keys[i] is not None:
+            self.cache.put( self.keys[i], file )
+
+    def _store( self, i, file ):
+        '''
+        Save the analysis of a file according to the options checked, and attach
+        it to its sample and to the list of files, in table order.
+        '''
+        sample = self.smap[ self.sample_names[i] ]
+        for event in file.events:
+            event.sample = sample
+
+        if self.options['meta']:
+            file.to_meta()
+        if self.writer is not None:
+            self.writer.put( i, file )
+        if self.options['save_json']:
+            file.to_json( file.filename+".json" )
+
+        self.files[i] = file
+        sample.files.append( file ) # Add the file to the appropriate sample
+        self.fileDone.emit( i, file )
+
+    def _run_serial( self ):
+        '''
+        Analyze the files one at a time in this thread.
+        '''
+        n_files = len( self.filenames )
+        for i, filename in enumerate( self.filenames ):
+            try:
+                file = self._load( i, filename )
+                if file is None:
+                    if self.options['chunk_size']:
+                        file = stream_file( filename, self.event_detector, self.options['chunk_size'] )
+                    else:
+                        file = File( filename+".abf" ) # Create a file object for one of the input files
+                        file.parse( parser=self.event_detector )
+                    if self.segmenter != '':
+                        for j, event in enumerate( file.events ):
+                            if not self.active:
+                                break
+                            if self.order and self.cutoff:
+                                event.filter( order=self.order, cutoff=self.cutoff )
+                            event.parse( parser=self.segmenter )
+                            self.n_events += 1
+                            self._emit_progress( ( i + ( j+1. ) / file.n ) / n_files )
+                    strip_trace( file )
+                    if self.active:
+                        self._cache( i, file )
+                else:
+                    self.n_events += file.n
+                self._store( i, file )
+            except Exception as e:
+                self.error.emit( i, e )
+
+            self._emit_progress( ( i+1. ) / n_files, force=True )
+            if not self.active:
+                break
+
+    def _run_parallel( self ):
+        '''
+        Analyze the files across a pool of worker processes. Files with a previous
+        analysis are loaded here, and the rest are sent out as jobs. Stopping the
+        worker cancels every job which has not started yet.
+        '''
+        detector_spec, segmenter_spec = portable( self.event_detector ), portable( self.segmenter )
+        n_files = len( self.filenames )
+
+        indices, jobs = [], []
+        for i, filename in enumerate( self.filenames ):
+            try:
+                file = self._load( i, filename )
+                if file is None:
+                    indices.append( i )
+                    jobs.append( ( filename, detector_spec, segmenter_spec, self.order, self.cutoff,
+                                   self.options['chunk_size'] ) )
+                else:
+                    self.n_events += file.n
+                    self._store( i, file )
+            except Exception as e:
+                self.error.emit( i, e )
+            if not self.active:
+                return
+
+        done = n_files - len( jobs )
+        self._emit_progress( float( done ) / n_files, force=True )
+        if not jobs:
+            return
+
+        self.pool = JobPool( min( self.options['workers'], len( jobs ) ) )
+        try:
+            for j, file, error in self.pool.imap( analyze_file, jobs ):
+                if error is None:
+                    try:
+                        self.n_events += file.n
+                        self._cache( indices[j], file )
+                        self._store( indices[j], file )
+                    except Exception as e:
+                        error = e
+                if error is not None:
+                    self.error.emit( indices[j], error )
+                done += 1
+                self._emit_progress( float( done ) / n_files, force=True )
+        finally:
+            self.pool = None
+
+class DecodeWorker( Qc.QThread ):
+    '''
+    Decodes events with one or more HMMs in a background thread, storing the results
+    to the decode cache of the main page. The events are sent to a pool of worker
+    processes in chunks of DECODE_CHUNK_SIZE, the chunks of every model going through
+    the same pool, or are decoded in this thread if there is only one worker or a HMM
+    cannot be pickled. Unless given, the number of workers is that of the main page,
+    which follows the worker processes chosen in the detection window. Each worker
+    process unpickles a HMM once, however many of its chunks it is given. Events
+    decoded before with a HMM are skipped, and HMMs with the same structure, as given
+    by structure_key, are decoded once, with the one which has the most events
+    decoded, and the others given its decodings.
+    '''
+    progress = Qc.pyqtSignal( float )
+    error = Qc.pyqtSignal( object )
+
+    def __init__( self, parent, models, events, workers=None ):
+        super( DecodeWorker, self ).__init__( parent )
+        self.decodings = parent.decodings
+        self.models = models
+        self.name = ", ".join( name for name, hmm in models )
+        self.events = events
+        self.workers = parent.workers if workers is None else workers
+        self.pool = None
+        self.cancelled = False
+
+    def stop( self ):
+        '''Stop after the chunk being decoded, keeping every chunk decoded so far.'''
+        self.cancelled = True
+        if self.pool is not None:
+            self.pool.cancel()
+
+    def run( self ):
+        store = self.decodings.store
+        offsets = store.segment_offsets
+
+        # Models which cannot be compared are each given a structure of their own
+        structures = OrderedDict()
+        for name, hmm in self.models:
+            structure = structure_key( hmm )
+            structures.setdefault( structure if structure is not None else name, [] ).append( ( name, hmm ) )
+
+        jobs, shared = [], []
+        for models in structures.values():
+            name, hmm = max( models, key=lambda model: self.decodings.columns( model[0] )[0].sum() )
+            shared.extend( ( name, other ) for other, _ in models if other != name )
+            key, data = model_key( hmm )
+            decoded = self.decodings.columns( name )[0]
+            sequences = [ ( i, store.segment_mean[ offsets[i]:offsets[i+1] ] ) 
+                            for i in self.events if not decoded[i] ]
+            jobs.extend( ( name, key, hmm, data, sequences[k:k+DECODE_CHUNK_SIZE] ) 
+                            for k in xrange( 0, len( sequences ), DECODE_CHUNK_SIZE ) )
+        total = sum( len( job[-1] ) for job in jobs )
+
+        if self.workers > 1 and len( jobs ) > 1 and all( job[3] is not None for job in jobs ):
+            self.pool = JobPool( self.workers )
+            results = self.pool.imap( decode_events, 
+                            ( ( key, data, chunk ) for name, key, hmm, data, chunk in jobs ) )
+        else:
+            results = self._decode_serially( jobs )
+
+        done = 0
+        for k, result, error in results:
+            if error is not None:
+                self.error.emit( error )
+                continue
+            for row in result:
+                self.decodings.put( jobs[k][0], *row )
+            done += len( jobs[k][-1] )
+            self.progress.emit( done / float( total ) )
+            if self.cancelled:
+                break
+        for source, name in shared:
+            self.decodings.share( source, name )
+        self.progress.emit( 1. )
+
+    def _decode_serially( self, jobs ):
+        ''' Decode jobs in this thread, yielding results as the job pool does. '''
+        for k, ( name, key, hmm, data, chunk ) in enumerate( jobs ):
+            if self.cancelled:
+                return
+            try:
+                yield k, decode_events( ( key, hmm, chunk ) ), None
+            except Exception as e:
+                yield k, None, e
+
+class TrainingWorker( Qc.QThread ):
+    '''
+    Trains the emissions of a profile HMM on events in a background thread, by
+    Viterbi or Baum-Welch training. Each iteration builds the model from the current
+    distributions, accumulates the counts of its states over the events in chunks of
+    DECODE_CHUNK_SIZE across a pool of worker processes, and estimates the
+    distributions again from the summed counts. Training stops after
+    TRAINING_ITERATIONS iterations, or once the mean log probability of the events
+    improves by less than TRAINING_THRESHOLD. The same worker processes are used for
+    every iteration. The trained model is then sent out to be added to the HMMs of
+    the main page as "<name> (trained)", which happens in the GUI thread. Unless
+    given, the number of workers is that of the main page. The transitions are those
+    of the profile modules, and are not trained.
+    '''
+    iteration = Qc.pyqtSignal( int, float, int, object )
+    error = Qc.pyqtSignal( object )
+    trained = Qc.pyqtSignal( object, object )
+
+    def __init__( self, parent, name, distributions, events, algorithm=TRAINING_ALGORITHMS[0],
+                  workers=None ):
+        super( TrainingWorker, self ).__init__( parent )
+        self.store = event_store( parent.experiment )
+        self.name = name
+        self.distributions = list( distributions )
+        self.events = events
+        self.algorithm = algorithm
+        self.workers = parent.workers if workers is None else workers
+        self.pool = None
+        self.cancelled = False
+        self.hmm = None
+
+    def stop( self ):
+        self.cancelled = True
+        if self.pool is not None:
+            self.pool.cancel()
+
+    def run( self ):
+        offsets = self.store.segment_offsets
+        sequences = [ ( i, self.store.segment_mean[ offsets[i]:offsets[i+1] ] ) for i in self.events ]
+        chunks = [ sequences[k:k+DECODE_CHUNK_SIZE] 
+                        for k in xrange( 0, len( sequences ), DECODE_CHUNK_SIZE ) ]
+
+        if self.workers > 1 and len( chunks ) > 1:
+            self.pool = JobPool( self.workers, persistent=True )
+        try:
+            distributions = self._train( chunks )
+        finally:
+            if self.pool is not None:
+                self.pool.close( terminate=self.cancelled )
+        if distributions is None:
+            return
+
+        name = "{} (trained)".format( self.name )
+        self.distributions = distributions
+        self.hmm = profile_model( distributions, name )
+        self.trained.emit( name, self.hmm )
+
+    def _train( self, chunks ):
+        '''
+        Run the iterations of training, returning the trained distributions, or None
+        if training was stopped or failed.
+        '''
+        distributions, last = self.distributions, None
+        for iteration in xrange( 1, TRAINING_ITERATIONS + 1 ):
+            hmm = profile_model( distributions, self.name )
+            positions = emission_positions( hmm, distributions )
+            if not ( positions >= 0 ).any():
+                self.error.emit( ValueError( "No state of {} emits the distributions it was built "
+                                             "from".format( self.name ) ) )
+                return None
+
+            key, data = model_key( hmm )
+            if self.pool is not None and data is not None:
+                results = self.pool.imap( training_counts, 
+                                ( ( key, data, self.algorithm, chunk ) for chunk in chunks ) )
+            else:
+                results = self._count_serially( key, hmm, chunks )
+
+            logp, fit = 0., 0
+            weights, sums, squares = np.zeros( ( 3, len( hmm.states ) ) )
+            for k, result, error in results:
+                if error is not None:
+                    self.error.emit( error )
+                    self.stop()
+                    continue
+                logp += result[0]
+                fit += result[1]
+                weights += result[2]
+                sums += result[3]
+                squares += result[4]
+            if self.cancelled:
+                return None
+            if fit == 0:
+                self.error.emit( ValueError( "{} has no path through any of the events".format( 
+                                                self.name ) ) )
+                return None
+
+            score = logp / fit
+            self.iteration.emit( iteration, score, fit, distributions )
+            distributions = reestimate( distributions, positions, weights, sums, squares )
+            if last is not None and score - last < TRAINING_THRESHOLD:
+                break
+            last = score
+        return distributions
+
+    def _count_serially( self, key, hmm, chunks ):
+        ''' Count chunks in this thread, yielding results as the job pool does. '''
+        for k, chunk in enumerate( chunks ):
+            try:
+                yield k, training_counts( ( key, hmm, self.algorithm, chunk ) ), None
+            except Exception as e:
+                yield k, None, e
+            if self.cancelled:
+                return
+
 class DetectionWindow( Qt.QWidget ):
     '''
     This window gives options for event detection and segment detection, and specifying which files
@@ -353,6 +3091,10 @@ class DetectionWindow( Qt.QWidget ):
         self.grid.addWidget( self.load_from_database, 14, 15, 1, 10 )
         self.load_from_database.setChecked(True)
 
+        self.use_cache = Qt.QCheckBox( "Use Local Analysis Cache" )
+        self.use_cache.setChecked( True )
+        self.grid.addWidget( self.use_cache, 17, 5, 1, 10 )
+
         self.grid.addWidget( Qt.QLabel( "JSON Options"), 15, 15, 1, 10 )
         self.save_to_json = Qt.QCheckBox( "Save Analysis to JSON" )
         self.load_from_json = Qt.QCheckBox( "Load Analysis From JSON" )
@@ -361,6 +3103,21 @@ class DetectionWindow( Qt.QWidget ):
         self.grid.addWidget( Qt.QLabel( "If you load, files must be in same file as Abada" ), 
                                                                                 18, 15, 1, 10 )
 
+        self.grid.addWidget( Qt.QLabel( "Parallel Options" ), 15, 5, 1, 5 )
+        self.workerInput = Qt.QSpinBox()
+        self.workerInput.setRange( 1, multiprocessing.cpu_count() )
+        self.workerInput.setValue( min( ANALYSIS_WORKERS, multiprocessing.cpu_count() ) )
+        self.workerInput.valueChanged[int].connect( self._set_workers )
+        self.grid.addWidget( self.workerInput, 16, 5, 1, 2 )
+        self.grid.addWidget( Qt.QLabel( "Worker Processes" ), 16, 7, 1, 3 )
+
+        self.streamCheckBox = Qt.QCheckBox( "Stream Files From Disk" )
+        self.chunkInput = Qt.QLineEdit()
+        self.chunkInput.setText( str( STREAM_CHUNK_MB ) )
+        self.grid.addWidget( self.streamCheckBox, 15, 10, 1, 5 )
+        self.grid.addWidget( self.chunkInput, 16, 10, 1, 2 )
+        self.grid.addWidget( Qt.QLabel( "Chunk Size (MB)" ), 16, 12, 1, 3 )
+
         self.metaAnalysis = Qt.QCheckBox( "Only Store Metadata" )
         self.grid.addWidget( self.metaAnalysis, 18, 5, 1, 15 )
         self.analysisButton = Qt.QPushButton( "Analyze" )
@@ -368,6 +3125,12 @@ class DetectionWindow( Qt.QWidget ):
 
         self.outputButton = Qt.QPushButton( "Output" )
         self.grid.addWidget( self.outputButton, 19, 6 )
+        self.outputFormat = Qt.QComboBox()
+        self.outputFormat.addItems( EXPORT_FORMATS )
+        self.grid.addWidget( self.outputFormat, 19, 7, 1, 4 )
+        self.outputSplit = Qt.QComboBox()
+        self.outputSplit.addItems( EXPORT_SPLITS )
+        self.grid.addWidget( self.outputSplit, 19, 11, 1, 4 )
 
         self.progressBar = Qt.QProgressBar( self )
         self.grid.addWidget( self.progressBar, 20, 5, 1, 19 )
@@ -375,11 +3138,17 @@ class DetectionWindow( Qt.QWidget ):
 
         self.stopButton = Qt.QPushButton( "Stop" )
         self.grid.addWidget( self.stopButton, 20, 24 )
+
+        self.cacheStats = Qt.QLabel( self.parent.analysis_cache.stats() )
+        self.grid.addWidget( self.cacheStats, 21, 5, 1, 20 )
+        self.statusLabel = Qt.QLabel( "" )
+        self.grid.addWidget( self.statusLabel, 22, 5, 1, 20 )
         self.connect( self.stopButton, Qc.SIGNAL("clicked()"), self._stop_analysis )
-        self._active = False
 
         self.connect( self.outputButton, Qc.SIGNAL( "clicked()" ), self._output )
         self.connect( self.analysisButton, Qc.SIGNAL( "clicked()" ), self._analyze )
+        if self.parent.analysis_worker is not None and self.parent.analysis_worker.isRunning():
+            self._attach( self.parent.analysis_worker )
         self._load_files()
         self.setLayout( self.grid )
 
@@ -429,15 +3198,18 @@ class DetectionWindow( Qt.QWidget ):
             i += 1
 
     def _stop_analysis( self ):
-        self._active=False
+        if self.parent.analysis_worker is not None:
+            self.parent.analysis_worker.stop()
 
     def _analyze( self ):
         ''' 
         Analyze each file by calling event detectors on each file, then by possibly
         calling segmenters on each event. This stores all of the information to 
-        the experiment graph.  
+        the experiment graph. The analysis runs in an AnalysisWorker, and across a
+        pool of processes if more than one worker process is selected.
         '''
-        self.parent.experiment.delete()
+        if self.parent.analysis_worker is not None and self.parent.analysis_worker.isRunning():
+            return
 
         # Load the event detector and set the appropriate parameters
         event_detector = self.eventDetectorOptions[ self.eventDetector ]
@@ -450,119 +3222,107 @@ class DetectionWindow( Qt.QWidget ):
         # Read in the file and appropriate sample names 
         filenames, sample_names = self._read_input()
 
-        # Create a mapping between the name of the sample, and the sample object
-        smap = { sample_name: Sample( label=sample_name ) for sample_name in set(sample_names) }
-        samples = smap.values()
-
         if self.filterCheckBox.checkState() == 2: # If filtering selected
             order = int( self.orderInput.text() ) 
             cutoff = float( self.filterInput.text() )
         else:
             order, cutoff = None, None 
 
-        # Keep a list of all the files
-        files = []
+        if self.streamCheckBox.checkState() == 2: # If streaming selected, convert MB to samples
+            chunk_size = int( float( self.chunkInput.text() ) * 1048576 / 8 )
+        else:
+            chunk_size = None
+
+        options = { 'workers': self.workerInput.value(),
+                    'chunk_size': chunk_size,
+                    'load_database': self.load_from_database.checkState() == 2,
+                    'load_json': self.load_from_json.checkState() == 2,
+                    'save_database': self.save_to_database.checkState() == 2,
+                    'save_json': self.save_to_json.checkState() == 2,
+                    'meta': self.metaAnalysis.checkState() == 2 }
+
+        self.progressBar.setMaximum( PROGRESS_STEPS )
+        self.progressBar.setValue( 0 )
+        self.progressBar.setFormat( "%p%" )
+
+        # Parent the worker to the main page, so it outlives this window
+        cache = self.parent.analysis_cache if self.use_cache.checkState() == 2 else None
+        worker = AnalysisWorker( self.parent, filenames, sample_names, event_detector,
+                                 segmenter, order, cutoff, options, cache )
+        self.parent.analysis_worker = worker
+        worker.analyzed.connect( self.parent._analyzed )
+        worker.finished.connect( self.parent._analysis_finished )
+        self._attach( worker )
+        worker.start()
+
+    def _set_workers( self, workers ):
+        ''' Use the number of worker processes chosen here for decoding as well. '''
+        self.parent.workers = workers
+
+    def _attach( self, worker ):
+        ''' Connect this window to the signals of a running analysis. '''
+        self.analysisButton.setEnabled( False )
+        worker.progress.connect( self._update_progress )
+        worker.fileDone.connect( self._file_done )
+        worker.error.connect( self._analysis_error )
+        worker.status.connect( self.statusLabel.setText )
+        worker.finished.connect( self._analysis_finished )
+
+    def _update_progress( self, fraction, n_events ):
+        '''
+        Show the progress of the analysis, with the throughput and the time remaining.
+        '''
+        elapsed = time.time() - self.parent.analysis_worker.start_time
+        rate = n_events / elapsed if elapsed > 0 else 0.
+        if fraction > 0:
+            eta = time.strftime( "%H:%M:%S", time.gmtime( elapsed * ( 1 - fraction ) / fraction ) )
+        else:
+            eta = "--:--:--"
+        self.progressBar.setValue( int( fraction * PROGRESS_STEPS ) )
+        self.progressBar.setFormat( "%p%  {:.0f} events/s  ETA {}".format( rate, eta ) )
 
-        self.progressBar.setValue(0)
-        self.progressBar.setMaximum(1)
-        self._active = True 
-        # For every pair of filename, sample name in the table
-        for i, ( sample_name, filename ) in enumerate( zip( sample_names, filenames ) ):
-            sample = smap[ sample_name ]
-            try:
-                if self.load_from_database.checkState() == 2:
-                    db_filename = filename.split("\\")[-1]
-                    file = File.from_database( database=DATABASE, host=DATABASE_HOST,
-                                               password=DATABASE_PASSWORD,
-                                               user=DATABASE_USER,
-                                               filename=db_filename,
-                                               eventDetector=event_detector.__class__.__name__,
-                                               eventDetectorParams=repr(event_detector),
-                                               segmenter=segmenter.__class__.__name__,
-                                               segmenterParams=repr(segmenter),
-                                               filterCutoff=cutoff, filterOrder=order )
-                elif self.load_from_json.checkState() == 2:
-                    if filename.endswith( "json" ):
-                        file = File.from_json( filename )
-                    else:
-                        file = File.from_json( filename+".json" )
-                else:
-                    raise Exception()
+    def _file_done( self, i, file ):
+        ''' Update the event count of a file once it has been analyzed. '''
+        self.fileList.setItem( i, 2, Qt.QTableWidgetItem( str( file.n ) ) )
+        self.cacheStats.setText( self.parent.analysis_cache.stats() )
 
-            except:
-                file = File( filename+".abf" ) # Create a file object for one of the input files
-                file.parse( parser=event_detector )
-                if segmenter != '':
-                    for j, event in enumerate( file.events ):
-                        if not self._active:
-                            break
-                        if sample:
-                            event.sample = sample
-                        if order and cutoff:
-                            event.filter( order=order, cutoff=cutoff )
-                        event.parse( parser=segmenter )
-                        self.progressBar.setValue( 1. + i * file.n + j ) 
-                        self.progressBar.setMaximum( len(filenames )*file.n )
-                        Qt.qApp.processEvents()
-                        time.sleep( 0.001 )
-            finally:
-                if self.metaAnalysis.checkState() == 2:
-                    file.to_meta()
-                if self.save_to_database.checkState() == 2:
-                    file.to_database( database=DATABASE, host=DATABASE_HOST,
-                                      password=DATABASE_PASSWORD,
-                                      user=DATABASE_USER )
-                if self.save_to_json.checkState() == 2:
-                    file.to_json( file.filename+".json" )
-
-            files.append( file ) # Add that file to the list of files
-            sample.files.append( file ) # Add the file to the appropriate sample
-
-            time.sleep( 0.001 )
-            self.progressBar.setValue( i+1 )
-            self.fileList.setItem( i, 2, Qt.QTableWidgetItem( str( file.n ) ) )
-            self.parent.input_files_n.append( file.n )
-            self.progressBar.setMaximum( len(filenames) )
-            Qt.qApp.processEvents()
-            if not self._active:
-                break
+    def _analysis_error( self, i, error ):
+        ''' Mark a file which could not be analyzed, keeping the reason as a tooltip. '''
+        item = Qt.QTableWidgetItem( "Error" )
+        item.setToolTip( "{}: {}".format( error.__class__.__name__, error ) )
+        self.fileList.setItem( i, 2, item )
 
-        self.parent.experiment = Experiment( filenames=[] )
-        self.parent.experiment.files = files
+    def _analysis_finished( self ):
+        self.analysisButton.setEnabled( True )
+        self.cacheStats.setText( self.parent.analysis_cache.stats() )
 
     def _output( self ):
         '''
-        Write out to a csv file all the data in an event, or a segment. 
-        '''
-        exp = self.parent.experiment # Unpack the experiment    
-        events = exp.events # Store references to all the events
-        with open( "abada_event_data.csv", "w" ) as out:
-            # Write a csv file out that contains all the data
-            out.write( "Filename,Sample,Start,Mean (pA),STD,Duration (s),Segment Count\n")
-            for event in events:
-                out.write("{filename},{sample},{start},{mean},{std},{duration},{segs}\n".format(
-                                    filename=event.file.filename,
-                                    sample=event.sample.label,
-                                    start=event.start,
-                                    mean=event.mean,
-                                    std=event.std,
-                                    duration=event.duration,
-                                    segs=event.n ) )
-
-        segments = exp.segments # Store references to all the states
-        with open( "abada_segment_data.csv", "w" ) as out:
-            # Write a csv file that contains all states 
-            out.write( "Filename,Sample,Mean (pA),Start,STD,Duration (s)\n")
-            for segment in segments:
-                out.write( "{filename},{sample},{start},{mean},{std},{duration}\n".format(
-                                filename=segment.event.file.filename,
-                                sample=segment.event.sample.label,
-                                start=segment.start + segment.event.start,
-                                mean=segment.mean,
-                                std=segment.std,
-                                duration=segment.duration ) )
+        Write out all the data in the events and segments, in the format and split
+        selected next to the output button.
+        '''
+        store = event_store( self.parent.experiment )
+        decodings = self.parent.decodings if self.parent.decodings.store is store else None
+        export_store( store, 
+                      fmt=str( self.outputFormat.currentText() ),
+                      split=str( self.outputSplit.currentText() ),
+                      excluded=self.parent.exclusion.excluded,
+                      decodings=decodings )
 
 class EventViewerWindow( Qt.QWidget ):
+    '''
+    Steps through the events of an experiment one at a time, plotting the current of
+    each. The trace is decimated to the width of the canvas, and redrawn at more
+    detail when zoomed in with the toolbar. The same axes and line collection are
+    reused from one event to the next, instead of building the figure again. The
+    PREFETCH_EVENTS events on either side of the one shown are prepared in the
+    background, so stepping to one of them only has to draw it.
+
+    Below the trace is an overview of the mean of every event, with excluded events
+    in red, which can be clicked to jump to an event. Events can also be jumped to by
+    number, or by stepping to the next one whose mean, duration or segment count is
+    in a range.
+    '''
     def __init__( self, parent ):
         super( EventViewerWindow, self ).__init__( parent )
         self.parent = parent
@@ -575,6 +3335,15 @@ class EventViewerWindow( Qt.QWidget ):
         self.canvas = FigureCanvas( self.fig )
         self.canvas.setParent( self )
         self.toolbar = NavigationToolbar( self.canvas, self )
+        self.subplot = self.fig.add_subplot( 111 )
+        self.subplot.set_xlabel( "Time (s)" )
+        self.subplot.set_ylabel( "Current (pA)" )
+        self.title = self.subplot.set_title( "" )
+        self.lines = LineCollection( [] )
+        self.subplot.add_collection( self.lines )
+        self.trace = None
+        self.drawing = False
+        self.subplot.callbacks.connect( 'xlim_changed', self._zoom )
 
         self.markButton = Qt.QCheckBox( "Exclude" )
         self.connect( self.markButton, Qc.SIGNAL( "clicked()" ), self._mark )
@@ -632,18 +3401,90 @@ class EventViewerWindow( Qt.QWidget ):
         grid.addWidget( self.eventDuration, 6, 5 )
         grid.addWidget( self.eventStateCount, 7, 5 )
 
+        self.overviewFig = plt.figure( facecolor='w', edgecolor='w' )
+        self.overview = FigureCanvas( self.overviewFig )
+        self.overview.setParent( self )
+        self.overview.setFixedHeight( 100 )
+        self.overview.mpl_connect( 'button_press_event', self._overview_clicked )
+        self.overviewPlot = self.overviewFig.add_axes( [ 0.05, 0.1, 0.9, 0.8 ] )
+        self.overviewPlot.set_yticks( [] )
+        self._draw_overview()
+
+        self.jumpInput = Qt.QSpinBox()
+        self.jumpInput.setRange( 1, max( len( self.events ), 1 ) )
+        jumpButton = Qt.QPushButton( "Go To Event" )
+        self.connect( jumpButton, Qc.SIGNAL( "clicked()" ), 
+                      lambda: self._jump( self.jumpInput.value() - 1 ) )
+
+        self.filterSummary = Qt.QComboBox()
+        for summary in sorted( EventStore.summaries ):
+            self.filterSummary.addItem( summary )
+        self.filterLow = Qt.QLineEdit( "0" )
+        self.filterHigh = Qt.QLineEdit( "100" )
+        matchButton = Qt.QPushButton( "Next Match" )
+        self.connect( matchButton, Qc.SIGNAL( "clicked()" ), self._next_match )
+
         grid.addWidget( self.canvas, 0, 0, 4, 10 )
         grid.addWidget( self.toolbar, 4, 0, 1, 10 )
+        grid.addWidget( self.overview, 8, 0, 1, 10 )
+        grid.addWidget( self.jumpInput, 9, 0 )
+        grid.addWidget( jumpButton, 9, 1 )
+        grid.addWidget( Qt.QLabel( "Between: " ), 9, 4 )
+        grid.addWidget( self.filterSummary, 9, 5 )
+        grid.addWidget( self.filterLow, 9, 6 )
+        grid.addWidget( self.filterHigh, 9, 7 )
+        grid.addWidget( matchButton, 9, 9 )
         self.setLayout( grid )
 
     def _mark( self ):
-        if self.markButton.checkState() == 0:
-            for i in range( len( self.parent.marked_event_indices ) ):
-                if self.parent.marked_event_indices[i] == self.i:
-                    del self.parent.marked_event_indices[i]
-                    break
-        elif self.markButton.checkState() == 2:
-            self.parent.marked_event_indices.append( self.i )
+        ''' Mark the event shown as excluded or not, if one is shown. '''
+        if not 0 <= self.i < event_store( self.parent.experiment ).n_events:
+            return
+        self.parent.exclusion.toggle( self.i, self.markButton.checkState() == 2 )
+        self._draw_excluded()
+        self.overview.draw_idle()
+
+    def _draw_overview( self ):
+        '''
+        Plot the mean of every event against its index, as single pixels so that tens
+        of thousands of events draw quickly, along with a marker at the event shown.
+        '''
+        store = event_store( self.parent.experiment )
+        index = np.arange( store.n_events )
+        self.overviewPlot.plot( index, store.event_mean, 'k,' )
+        self.excludedLine, = self.overviewPlot.plot( [], [], 'r.', markersize=3 )
+        self.overviewCursor = self.overviewPlot.axvline( 0, color='b', visible=False )
+        self.overviewPlot.set_xlim( -0.5, max( store.n_events - 0.5, 0.5 ) )
+        self._draw_excluded()
+        self.overview.draw()
+
+    def _draw_excluded( self ):
+        store = event_store( self.parent.experiment )
+        excluded = np.where( self.parent.exclusion.excluded )[0]
+        self.excludedLine.set_data( excluded, store.event_mean[ excluded ] )
+
+    def _overview_clicked( self, click ):
+        if click.inaxes is self.overviewPlot and click.xdata is not None:
+            self._jump( int( round( click.xdata ) ) )
+
+    def _jump( self, i ):
+        ''' Show event i, if there is one. '''
+        if 0 <= i < len( self.events ):
+            self.i = i
+            self._plot()
+
+    def _next_match( self ):
+        '''
+        Show the next event whose chosen summary lies between the two bounds given.
+        '''
+        try:
+            low, high = float( self.filterLow.text() ), float( self.filterHigh.text() )
+        except ValueError:
+            return
+        store = event_store( self.parent.experiment )
+        i = store.next_match( str( self.filterSummary.currentText() ), low, high, self.i )
+        if i is not None:
+            self._jump( i )
 
     def _move( self, direction ):
         '''
@@ -663,96 +3504,135 @@ class EventViewerWindow( Qt.QWidget ):
         belongs to. If colored by state, it will color each segment according to a color cycle of
         a few colors. 
         '''
-        self.fig.clf() # Make it so the next plotting event removes the current plot 
         event = self.events[ self.i ] # Pull the next event
 
         # Remember if the user marked the event as a bad one or not
-        if self.i in self.parent.marked_event_indices:
+        if self.parent.exclusion.is_excluded( self.i ):
             self.markButton.setCheckState( 2 )
         else:
             self.markButton.setCheckState( 0 )
 
         if event != None:
-            # If Black and White plot selected, or no states are stored to the event
-            if self.colorGroup.checkedId() == 0 or event.n == 'N/A':
-                event.plot( color='k' )
-
-            # If color was selected, and states are present in the event
-            elif self.colorGroup.checkedId() == 1:
-                event.plot( color='cycle', alpha=0.75 )
-
-            # If color-by-hmm was selected, and states are present 
-            elif self.colorGroup.checkedId() == 2:
-                hmm = self.parent.hmms[ str(self.hmmDropBox.currentText() ) ]
-                event.plot( hmm=hmm, color='hmm' )
-
-            plt.title( "Event {i}: in {filename} at {time}s".format( i=self.i+1, 
+            key, color, hmm, decode = self._style( self.i )
+            prepared = self.parent.render_cache.get( key )
+            if prepared is None:
+                prepared = prepare_event( event, color, hmm, self._bins(), decode )
+                self.parent.render_cache.put( key, prepared )
+            self.trace, lines = prepared
+
+            self._draw_trace( lines )
+            self.title.set_text( "Event {i}: in {filename} at {time}s".format( i=self.i+1, 
                                                                      filename=event.file.filename, 
                                                                      time=round(event.start, 2)))
             self.canvas.draw()
 
-            self.eventFilename.setText( Qc.QString( event.file.filename ) )
-            self.eventTime.setText( Qc.QString( str( round( event.start, 2 ) ) + " s" ) )
-            try:
-                self.eventSample.setText( Qc.QString( event.sample.label ) )
-            except:
-                pass
-            self.eventMean.setText( Qc.QString( str( round( event.mean, 2 ) ) + " pA" ) ) 
-            self.eventDuration.setText( Qc.QString( str( round( event.duration, 2 ) ) + " s" ) )
+            store = event_store( self.parent.experiment )
+            self.eventFilename.setText( Qc.QString( store.filenames[ store.event_file[ self.i ] ] ) )
+            self.eventTime.setText( Qc.QString( str( round( store.event_start[ self.i ], 2 ) ) + " s" ) )
+            self.eventSample.setText( Qc.QString( store.sample_labels[ store.event_sample[ self.i ] ] ) )
+            self.eventMean.setText( Qc.QString( str( round( store.event_mean[ self.i ], 2 ) ) + " pA" ) ) 
+            self.eventDuration.setText( Qc.QString( str( round( store.event_duration[ self.i ], 2 ) ) + " s" ) )
             self.eventStateCount.setText( Qc.QString( str( event.n ) ) )
+            self.jumpInput.setValue( self.i % len( self.events ) + 1 )
+            self.overviewCursor.set_xdata( [ self.i % len( self.events ) ] * 2 )
+            self.overviewCursor.set_visible( True )
+            self.overview.draw_idle()
+            self._prefetch()
+
+    def _style( self, i ):
+        '''
+        Return the render cache key for drawing event i as the color buttons are set,
+        along with the color and the HMM to draw it with, and a function which gives
+        its hidden states through the decode cache.
+        '''
+        i %= len( self.events )
+        event = self.events[i]
+        hmm_name, decode = None, None
+        # If Black and White plot selected, or no states are stored to the event
+        if self.colorGroup.checkedId() == 0 or event.n == 'N/A':
+            color, hmm = 'k', None
+        # If color was selected, and states are present in the event
+        elif self.colorGroup.checkedId() == 1:
+            color, hmm = 'cycle', None
+        # If color-by-hmm was selected, and states are present 
+        elif self.colorGroup.checkedId() == 2:
+            hmm_name = str( self.hmmDropBox.currentText() )
+            color, hmm = 'hmm', self.parent.hmms[ hmm_name ]
+            decoder = functools.partial( self.parent.decodings.decode, hmm_name, hmm, i )
+            decode = lambda means: decoder( np.array( means ) )
+        else:
+            color, hmm = 'k', None
+        return ( i, color, hmm_name, self._bins() ), color, hmm, decode
+
+    def _prefetch( self ):
+        '''
+        Have the prefetcher prepare the events on either side of this one, nearest
+        first, so that stepping to them is instant.
+        '''
+        n = len( self.events )
+        jobs = []
+        for k in xrange( 1, PREFETCH_EVENTS + 1 ):
+            for i in self.i + k, self.i - k:
+                if 0 <= i < n and self.events[i] is not None:
+                    key, color, hmm, decode = self._style( i )
+                    jobs.append( ( key, self.events[i], color, hmm, key[-1], decode ) )
+        self.parent.prefetcher.want( jobs )
+
+    def _draw_trace( self, lines ):
+        '''
+        Put the whole of the current trace into the line collection, and fit the axes
+        to it. Zooming from here on starts again from the whole event.
+        '''
+        trace = self.trace
+        self.lines.set_segments( lines )
+        self.lines.set_color( trace.colors )
+        self.lines.set_alpha( trace.alpha )
+        margin = 0.05 * ( trace.ylim[1] - trace.ylim[0] ) or 1.
+        self.drawing = True
+        self.subplot.set_xlim( 0, trace.duration or 1. )
+        self.subplot.set_ylim( trace.ylim[0] - margin, trace.ylim[1] + margin )
+        self.drawing = False
+        self.toolbar.update()
+
+    def _zoom( self, axes ):
+        '''
+        Redraw the part of the trace inside the new limits of the x axis, at as much
+        detail as the canvas can show.
+        '''
+        if self.drawing or self.trace is None:
+            return
+        self.lines.set_segments( self.trace.lines( self._bins(), self.subplot.get_xlim() ) )
+        self.canvas.draw_idle()
+
+    def _bins( self ):
+        return max( int( self.subplot.bbox.width ), 1 )
 
 class AnalysisWindow( Qt.QWidget ):
     '''
     This window is for displaying basic statistical information from the segments gathered in
     the previous windows, whether they be from an event detector, state detector, or a HMM.
     The statistics are gathered through the use of a dictionary of lambda expressions stored 
-    to self.axes. 
+    to self.axes. Events can be excluded from it by rules over the features of events and
+    their segments, which are applied to every event at once. Scatter plots of more than
+    DENSITY_THRESHOLD points are drawn as a single image of the density of points instead,
+    which is binned again when zoomed. Events can be decoded with a HMM, after which the
+    log probability of the Viterbi path and the log-likelihood of each event, and the
+    hidden state of each segment, can be plotted. Scoring decodes them with every HMM
+    loaded, adding the model under which each event is most likely.
     '''
     def __init__( self, parent ):
         super( AnalysisWindow, self ).__init__( parent )
         self.parent = parent
         self.last_datatype = None # Store the last attempt to plot, in case only recoloring is needed
-        try: # Find indices which are unmarked by reversing the marked list
-            n = len( self.parent.experiment.events ) 
-            self.parent.unmarked_event_indices = [ i for i in xrange( n ) 
-                                                   if i not in self.parent.marked_event_indices ]
-        except: # If no marked list exists, or no experiment exists, do not plot anything
-            self.parent.unmarked_event_indices = [] 
+        self.density = None # The points drawn as a density image, to bin again on zooming
+        self.density_cache = OrderedDict()
 
         self.hmmDropBox = Qt.QComboBox()
         for name in self.parent.hmms.keys():
             self.hmmDropBox.addItem( name )
 
-        # Store the functions which gather statistical information as lambda expressions requiring
-        # two keys to get to it-- the type and the statistical information. 
+        self._select()
 
-        unmarked = self.parent.unmarked_event_indices
-        hmm = str( self.hmmDropBox.currentText() )
-
-        exp = self.parent.experiment
-        try:
-            events = [ event for i, event in enumerate( exp.events ) if i in unmarked ]
-        except:
-            events = []
-
-        try:
-            segs = reduce( list.__add__, [ event.segments for event in events ] )
-        except:
-            segs = []
-
-        self.axes = { 'event': { 
-                        'Duration (s)': np.array([event.duration for event in events]), 
-                        'Mean (pA)': np.array([event.mean for event in events]),
-                        'Segment Count': np.array([event.n for event in events]),
-                        'Count': None
-                        },
-                      'segment': {
-                        'Duration (s)': np.array( [seg.duration for seg in segs] ),
-                        'Mean (pA)': np.array( [seg.mean for seg in segs]),
-                        'STD (pA)' : np.array( [seg.std for seg in segs] ),
-                        'Count': None
-                        }
-                    }
         grid = Qt.QGridLayout()
 
         # Initiate the event plotting dropdown boxes
@@ -789,17 +3669,74 @@ class AnalysisWindow( Qt.QWidget ):
 
         grid.addWidget( Divider(), 11, 5, 1, 5 )
 
+        # Initiate the rule editing widgets
+        self.ruleLevel = Qt.QComboBox()
+        for level in sorted( RULE_FEATURES ):
+            self.ruleLevel.addItem( level )
+        self.ruleLevel.activated[str].connect( self._rule_features )
+        self.ruleFeature = Qt.QComboBox()
+        self._rule_features( self.ruleLevel.currentText() )
+        self.ruleTest = Qt.QComboBox()
+        for test in RULE_TESTS:
+            self.ruleTest.addItem( test )
+        self.ruleLow = Qt.QLineEdit( "0" )
+        self.ruleHigh = Qt.QLineEdit( "0" )
+        self.ruleList = Qt.QListWidget()
+        self.ruleSummary = Qt.QLabel( "" )
+        addRuleButton = Qt.QPushButton( "Add Rule" )
+        removeRuleButton = Qt.QPushButton( "Remove Rule" )
+        applyRulesButton = Qt.QPushButton( "Apply Rules" )
+        self.connect( addRuleButton, Qc.SIGNAL( "clicked()" ), self._add_rule )
+        self.connect( removeRuleButton, Qc.SIGNAL( "clicked()" ), self._remove_rule )
+        self.connect( applyRulesButton, Qc.SIGNAL( "clicked()" ), self._apply_rules )
+        for rule in self.parent.exclusion_rules:
+            self.ruleList.addItem( rule_name( rule ) )
+
+        grid.addWidget( Qt.QLabel( "Exclude: " ), 12, 5 )
+        grid.addWidget( self.ruleLevel, 12, 6 )
+        grid.addWidget( self.ruleFeature, 12, 7, 1, 2 )
+        grid.addWidget( self.ruleTest, 13, 6 )
+        grid.addWidget( self.ruleLow, 13, 7 )
+        grid.addWidget( self.ruleHigh, 13, 8 )
+        grid.addWidget( addRuleButton, 14, 6 )
+        grid.addWidget( removeRuleButton, 14, 7 )
+        grid.addWidget( applyRulesButton, 14, 8 )
+        grid.addWidget( self.ruleList, 15, 5, 2, 4 )
+        grid.addWidget( self.ruleSummary, 17, 5, 1, 4 )
+
         grid.addWidget( Divider(), 18, 5, 1, 5 )
         grid.addWidget( Qt.QLabel( "Color By:" ), 19, 5 )
         self.colorByDropdown = Qt.QComboBox()
         self.colorByDropdown.addItem( "Uniform Cyan" )
-        self.colorByDropdown.addItem( "Filename" )
-        self.colorByDropdown.addItem( "Sample" )
+        for grouping in self.groups:
+            self.colorByDropdown.addItem( grouping )
 
         color = lambda: self._color( color_scheme = str( self.colorByDropdown.currentText()))
         self.colorByDropdown.activated[str].connect( color ) 
         grid.addWidget( self.colorByDropdown, 19, 6, 1, 3)
 
+        # Initiate the decoding widgets
+        self.decodeButton = Qt.QPushButton( "Decode" )
+        self.scoreButton = Qt.QPushButton( "Score All" )
+        self.stopDecodeButton = Qt.QPushButton( "Stop" )
+        self.decodeProgress = Qt.QProgressBar( self )
+        self.decodeProgress.setMaximum( PROGRESS_STEPS )
+        self.decodeStatus = Qt.QLabel( "" )
+        self.connect( self.decodeButton, Qc.SIGNAL( "clicked()" ), 
+                        lambda: self._decode( [ str( self.hmmDropBox.currentText() ) ] ) )
+        self.connect( self.scoreButton, Qc.SIGNAL( "clicked()" ), 
+                        lambda: self._decode( self.parent.hmms.keys() ) )
+        self.connect( self.stopDecodeButton, Qc.SIGNAL( "clicked()" ), self._stop_decoding )
+        grid.addWidget( Qt.QLabel( "Decode With:" ), 20, 5 )
+        grid.addWidget( self.hmmDropBox, 20, 6, 1, 2 )
+        grid.addWidget( self.decodeButton, 20, 8 )
+        grid.addWidget( self.scoreButton, 21, 8 )
+        grid.addWidget( self.decodeProgress, 21, 5, 1, 3 )
+        grid.addWidget( self.decodeStatus, 22, 5, 1, 3 )
+        grid.addWidget( self.stopDecodeButton, 22, 8 )
+        if self.parent.decode_worker is not None and self.parent.decode_worker.isRunning():
+            self._attach( self.parent.decode_worker )
+
         self.connect( self.event_display, Qc.SIGNAL( "clicked()" ), 
                         lambda: self._plot( datatype = 'event' ) )
         self.connect( self.segment_display, Qc.SIGNAL( "clicked()" ), \
@@ -809,12 +3746,175 @@ class AnalysisWindow( Qt.QWidget ):
         grid.addWidget( self.toolbar, 25, 0, 1, 5 )
         self.setLayout( grid )
 
+    def _select( self ):
+        '''
+        Select the events which are not excluded, and their segments, from the columnar
+        store, and gather the statistics of each which can be plotted.
+        '''
+        store = event_store( self.parent.experiment )
+        self.events = self.parent.exclusion.kept()
+        self.segments = self.parent.exclusion.kept_segments( store )
+
+        self.axes = { 'event': { 
+                        'Duration (s)': store.event_duration[ self.events ], 
+                        'Mean (pA)': store.event_mean[ self.events ],
+                        'Segment Count': store.event_count[ self.events ],
+                        'Count': None
+                        },
+                      'segment': {
+                        'Duration (s)': store.segment_duration[ self.segments ],
+                        'Mean (pA)': store.segment_mean[ self.segments ],
+                        'STD (pA)' : store.segment_std[ self.segments ],
+                        'Count': None
+                        }
+                    }
+        self.density_cache.clear()
+
+        # Groupings of events and segments, as ( labels, event codes, segment codes )
+        self.groups = OrderedDict( [ 
+                        ( 'Filename', ( store.filenames, store.event_file, store.segment_file ) ),
+                        ( 'Sample', ( store.sample_labels, store.event_sample, store.segment_sample ) ) ] )
+        self.codes = {}
+
+        # Statistics of every model the events have been decoded with
+        decodings = self.parent.decodings
+        if decodings.store is store:
+            names = []
+            for name in decodings.names():
+                decoded, logp, states, loglik = decodings.columns( name )
+                if not decoded.any():
+                    continue
+                names.append( name )
+                n_states = max( int( states.max() ) + 1, 1 )
+                visited = np.unique( store.segment_event[ states >= 0 ] * n_states + states[ states >= 0 ] )
+                visited = np.bincount( visited // n_states, minlength=store.n_events )
+                self.axes['event'][ 'Viterbi Log-Probability ({})'.format( name ) ] = np.where( 
+                    np.isfinite( logp[ self.events ] ), logp[ self.events ], np.nan )
+                self.axes['event'][ 'Log-Likelihood ({})'.format( name ) ] = np.where( 
+                    np.isfinite( loglik[ self.events ] ), loglik[ self.events ], np.nan )
+                self.axes['event'][ 'States Visited ({})'.format( name ) ] = np.where( 
+                    decoded[ self.events ], visited[ self.events ], np.nan )
+                self.axes['segment'][ 'Hidden State ({})'.format( name ) ] = np.where( 
+                    states[ self.segments ] >= 0, states[ self.segments ], np.nan )
+
+            # Events which no model fits go in a group of their own after the models
+            if len( names ) > 1:
+                best = decodings.best( names )
+                self.axes['event'][ 'Best Model' ] = np.where( best[ self.events ] >= 0, 
+                                                        best[ self.events ], np.nan )
+                best[ best < 0 ] = len( names )
+                self.groups[ 'Best Model' ] = ( names + [ 'None' ], best, best[ store.segment_event ] )
+
+    def _rule_features( self, level ):
+        self.ruleFeature.clear()
+        for feature in sorted( RULE_FEATURES[ str( level ) ] ):
+            self.ruleFeature.addItem( feature )
+
+    def _add_rule( self ):
+        try:
+            low, high = float( self.ruleLow.text() ), float( self.ruleHigh.text() )
+        except ValueError:
+            self.ruleSummary.setText( "Rule bounds must be numbers" )
+            return
+        rule = ( str( self.ruleLevel.currentText() ), str( self.ruleFeature.currentText() ),
+                 str( self.ruleTest.currentText() ), low, high )
+        self.parent.exclusion_rules.append( rule )
+        self.ruleList.addItem( rule_name( rule ) )
+
+    def _remove_rule( self ):
+        i = self.ruleList.currentRow()
+        if i >= 0:
+            del self.parent.exclusion_rules[i]
+            self.ruleList.takeItem( i )
+
+    def _apply_rules( self ):
+        '''
+        Exclude every event matched by a rule, in place of whatever rules excluded
+        before, and show how many events each rule removed. Plots are redrawn without
+        the excluded events.
+        '''
+        store = event_store( self.parent.experiment )
+        rules = self.parent.exclusion_rules
+        counts = self.parent.exclusion.apply( store, rules )
+        for i, ( rule, ( matched, removed ) ) in enumerate( zip( rules, counts ) ):
+            self.ruleList.item( i ).setText( "{}: {} events, {} not excluded before".format( 
+                                                rule_name( rule ), matched, removed ) )
+        self.ruleSummary.setText( "{} of {} events excluded".format( 
+                                    int( self.parent.exclusion.excluded.sum() ), store.n_events ) )
+        self._select()
+        if self.last_datatype is not None:
+            self._color( color_scheme = str( self.colorByDropdown.currentText() ) )
+
     def _init_axis( self, plot_type ):
         axis = Qt.QComboBox()
         for option in self.axes[plot_type]:
             axis.addItem( option )
         return axis   
 
+    def _refresh_axes( self ):
+        '''
+        Fill the axis and color dropdown boxes again, keeping what was selected in each.
+        '''
+        for axis, plot_type in ( ( self.event_xaxis, 'event' ), ( self.event_yaxis, 'event' ),
+                                 ( self.segment_xaxis, 'segment' ), ( self.segment_yaxis, 'segment' ) ):
+            selected = axis.currentText()
+            axis.clear()
+            for option in self.axes[plot_type]:
+                axis.addItem( option )
+            axis.setCurrentIndex( max( axis.findText( selected ), 0 ) )
+        selected = self.colorByDropdown.currentText()
+        self.colorByDropdown.clear()
+        self.colorByDropdown.addItem( "Uniform Cyan" )
+        for grouping in self.groups:
+            self.colorByDropdown.addItem( grouping )
+        self.colorByDropdown.setCurrentIndex( max( self.colorByDropdown.findText( selected ), 0 ) )
+
+    def _decode( self, names ):
+        '''
+        Decode every event which is not excluded with the named HMMs, in the
+        background. Events decoded with a HMM before are not decoded again.
+        '''
+        names = [ name for name in names if name in self.parent.hmms ]
+        worker = self.parent.decode_worker
+        if not names or ( worker is not None and worker.isRunning() ):
+            return
+        worker = DecodeWorker( self.parent, [ ( name, self.parent.hmms[ name ] ) for name in names ], 
+                               self.events )
+        self.parent.decode_worker = worker
+        self._attach( worker )
+        worker.start()
+
+    def _stop_decoding( self ):
+        ''' Stop the running decoding. Events decoded so far keep their decodings. '''
+        if self.parent.decode_worker is not None:
+            self.parent.decode_worker.stop()
+
+    def _attach( self, worker ):
+        ''' Connect this window to the signals of a running decoding. '''
+        self.decodeButton.setEnabled( False )
+        self.scoreButton.setEnabled( False )
+        self.decodeStatus.setText( "Decoding with {}".format( worker.name ) )
+        worker.progress.connect( self._decode_progress )
+        worker.error.connect( self._decode_error )
+        worker.finished.connect( self._decoded )
+
+    def _decode_progress( self, fraction ):
+        self.decodeProgress.setValue( int( fraction * PROGRESS_STEPS ) )
+
+    def _decode_error( self, error ):
+        self.decodeStatus.setText( "{}: {}".format( error.__class__.__name__, error ) )
+
+    def _decoded( self ):
+        ''' Make the statistics of the new decodings available to plot. '''
+        self.decodeButton.setEnabled( True )
+        self.scoreButton.setEnabled( True )
+        worker = self.parent.decode_worker
+        if worker.decodings is self.parent.decodings:
+            self.decodeStatus.setText( "{} with {}".format( 
+                "Stopped decoding" if worker.cancelled else "Decoded", worker.name ) )
+            self._select()
+            self._refresh_axes()
+
     def _plot( self, datatype, color='c'  ):
         '''
         The plotting function. Is responsible for gathering inputs from all input widgets, and
@@ -826,6 +3926,7 @@ class AnalysisWindow( Qt.QWidget ):
         self.subplot.hold( False )
         self.subplot.plot( [0,0], [0,0] )
         self.subplot.hold( True )
+        self.density = None
 
         # If plotting events, get input from the event widgets
         if datatype == 'event':
@@ -857,14 +3958,14 @@ class AnalysisWindow( Qt.QWidget ):
                 y = self.axes[ datatype ][ yaxis ]
             
             # Color correctly
-            if len(color) == 1:
-                self.subplot.hist( y, fc=color, alpha=0.3, bins=25, 
+            # Points with no value, such as events which were not decoded, are left out
+            if not isinstance( color, tuple ):
+                self.subplot.hist( y[ np.isfinite( y ) ], fc=color, alpha=0.3, bins=25, 
                                         orientation='horizontal', label = "Aggregate Data" )
             else:
-                for c in set( color ):
-                    self.subplot.hist( y[ np.where( color == c )[0] ], 
-                                        fc=c, alpha=0.3, bins=25, orientation='horizontal', 
-                                        label = self.lmap[c] )
+                for part, c, label in self._split( y, color, finite=True ):
+                    self.subplot.hist( part, fc=c, alpha=0.3, bins=25, orientation='horizontal', 
+                                        label = label )
 
         # If y-axis is count, create a vertical histogram
         elif yaxis == 'Count':
@@ -880,13 +3981,15 @@ class AnalysisWindow( Qt.QWidget ):
                 x = self.axes[ datatype ][ xaxis ]
             
             # Color the histogram according to if a single, or multiple, colors are given.
-            if len(color) == 1:
-                self.subplot.hist( x, fc=color, alpha=0.3, bins=25, label = "Aggregate Data" )
+            if not isinstance( color, tuple ):
+                self.subplot.hist( x[ np.isfinite( x ) ], fc=color, alpha=0.3, bins=25, 
+                                        label = "Aggregate Data" )
             else:
-                self.subplot.hist( [ x[ np.where( color == c )[0] ] for c in set( color )  ],
-                                    color=[ c for c in set( color ) ], alpha=0.4, bins=25, 
-                                    label = [ self.lmap[c] for c in set( color ) ],
-                                    stacked=True, fill=True ) 
+                groups = self._split( x, color, finite=True )
+                if groups:
+                    parts, colors, labels = zip( *groups )
+                    self.subplot.hist( list( parts ), color=list( colors ), alpha=0.4, bins=25, 
+                                        label = list( labels ), stacked=True, fill=True ) 
 
         # If not ploting histograms, plot a scatterplot
         else:
@@ -908,12 +4011,16 @@ class AnalysisWindow( Qt.QWidget ):
                 y = self.axes[ datatype ][ yaxis ]
 
             # Color the histogram according to if a single, or multiple, colors are given.
-            if len(color) == 1:
+            if len( x ) > DENSITY_THRESHOLD:
+                self._density( x, y, color )
+            elif not isinstance( color, tuple ):
                 self.subplot.scatter( x, y, color=color, s=3, marker='o', label = "Aggregate Data"  )
             else:
-                for c in set( color ):
-                    self.subplot.scatter( x[ np.where( color == c )[0] ], y[ np.where( color == c )[0] ], 
-                                            s=3, color=c, marker='o', label = self.lmap[c]  )
+                # One scatter for every group, with empty plots standing in for them in the legend
+                codes, palette, labels = color
+                self.subplot.scatter( x, y, c=palette[ codes ], s=3, marker='o', edgecolors='none' )
+                for g in np.where( np.bincount( codes, minlength=len( labels ) ) > 0 )[0]:
+                    self.subplot.plot( [], [], 'o', color=palette[g], label=labels[g] )
 
         # Set the legend and axes, then draw the image
         self.subplot.legend( loc = "best", numpoints = 1 )
@@ -934,52 +4041,110 @@ class AnalysisWindow( Qt.QWidget ):
         except:
             pass
 
-    def _color( self, color_scheme ):
+    def _density( self, x, y, color ):
         '''
-        Given different inputs for how to color a dataset, will produce the list of colors
-        from the color cycle which correspond to the grouping selected. Must return a list
-        of colors of the same length as the list of points, and must set self.fmap to be a
-        mapping between the colors, and the name of the group to be displayed. 
+        Draw the points as one density image, colored by group, in place of a scatter
+        plot. Counts are kept for each set of points, groups, limits and bins drawn
+        recently, so recoloring back, or zooming back out, needs no binning at all.
         '''
-        # Set up references to stored data to make calls less long
-        exp = self.parent.experiment
-        indices = self.parent.unmarked_event_indices
-        events = [ event for i, event in enumerate( exp.events ) if i in indices ]
-        segments = reduce( list.__add__, [ event.segments for event in events ] )
-
-        # A 10 color color-cycle, assuming that there are only 10 possible groups
-        color_cycle = [ 'r', 'b', 'g', 'm', 'c', 'w', 'k', 'y', '0.25', '0.75' ]
+        if not isinstance( color, tuple ):
+            palette, codes = [ color ], np.zeros( len( x ), dtype=np.int64 )
+            labels = [ "Aggregate Data" ]
+        else:
+            codes, palette, labels = color
+
+        finite = np.isfinite( x ) & np.isfinite( y )
+        xlim = ( x[ finite ].min(), x[ finite ].max() ) if finite.any() else ( 0., 1. )
+        ylim = ( y[ finite ].min(), y[ finite ].max() ) if finite.any() else ( 0., 1. )
+        self.density = ( x, y, codes, palette )
+        self.densityImage = self.subplot.imshow( np.zeros( ( 1, 1, 4 ) ), origin='lower', 
+                                                 aspect='auto', interpolation='nearest', 
+                                                 extent=( xlim[0], xlim[1], ylim[0], ylim[1] ) )
+        for c, label in zip( palette, labels ):
+            self.subplot.plot( [], [], 's', color=c, label=label )
+        self.subplot.set_xlim( *xlim )
+        self.subplot.set_ylim( *ylim )
+        self._rebin()
+        self.subplot.callbacks.connect( 'xlim_changed', self._rebin )
+        self.subplot.callbacks.connect( 'ylim_changed', self._rebin )
+
+    def _rebin( self, axes=None ):
+        '''
+        Bin the density image again over the current limits of the plot, at about one
+        bin for every two pixels.
+        '''
+        if self.density is None:
+            return
+        x, y, codes, palette = self.density
+        xlim, ylim = self.subplot.get_xlim(), self.subplot.get_ylim()
+        bins = ( min( max( int( self.subplot.bbox.width ) // 2, 1 ), DENSITY_MAX_BINS ),
+                 min( max( int( self.subplot.bbox.height ) // 2, 1 ), DENSITY_MAX_BINS ) )
+
+        # Entries hold on to their points, so that an id is never reused for others
+        key = ( id( x ), id( y ), id( codes ), xlim, ylim, bins )
+        entry = self.density_cache.pop( key, None )
+        if entry is None:
+            entry = ( x, y, codes, density_counts( x, y, codes, len( palette ), xlim, ylim, bins ) )
+        self.density_cache[ key ] = entry
+        counts = entry[3]
+        while len( self.density_cache ) > 16:
+            self.density_cache.popitem( last=False )
+
+        self.densityImage.set_data( density_image( counts, palette ) )
+        self.densityImage.set_extent( ( xlim[0], xlim[1], ylim[0], ylim[1] ) )
+        if axes is not None:
+            self.canvas.draw_idle()
+
+    def _split( self, values, color, finite=False ):
+        '''
+        Split values by their group codes, returning ( values, color, label ) for
+        every group which has any, with a single sort instead of a pass per group.
+        If finite, values which are NaN or infinite are dropped first.
+        '''
+        codes, palette, labels = color
+        if finite:
+            kept = np.isfinite( values )
+            values, codes = values[ kept ], codes[ kept ]
+        order = np.argsort( codes, kind='mergesort' )
+        bounds = np.searchsorted( codes[ order ], np.arange( 1, len( labels ) ) )
+        return [ ( part, palette[g], labels[g] ) 
+                    for g, part in enumerate( np.split( values[ order ], bounds ) ) if len( part ) ]
 
-        # Uniform cyan, unless otherwise specified
+    def _color( self, color_scheme ):
+        '''
+        Color the last plot by one of the groupings in self.groups, or uniform cyan if
+        another is given. Points are passed to _plot as a tuple of their group codes,
+        a palette of colors indexed by group code, and the label of each group.
+        '''
         colors = 'c'
-
-        # If they select the filename grouping..
-        if color_scheme == 'Filename':
-            files = exp.files
-            cmap = { file.filename: color_cycle[i%len(color_cycle)+1] for i, file in enumerate( files ) }
-            self.lmap = { value: key for key, value in cmap.items() }
-            if self.last_datatype == 'event':
-                colors = np.array( [ cmap[ event.file.filename ] for event in events ] )
-            elif self.last_datatype == 'segment': 
-                colors = np.array( [ cmap[ seg.event.file.filename ] for seg in segments ] )
-
-        # If the user selects the sample grouping..
-        elif color_scheme == 'Sample':
-            samples = exp.samples
-            cmap = { sample.label: color_cycle[i] for i, sample in enumerate( samples ) }
-            self.lmap = { value: key for key, value in cmap.items() }
-            if self.last_datatype == 'event':
-                colors = np.array( [ cmap[ event.sample.label ] for event in events ] )
-            elif self.last_datatype == 'segment':
-                colors = np.array( [ cmap[ seg.event.sample.label ] for seg in segments ] )
+        if color_scheme in self.groups and self.last_datatype in ( 'event', 'segment' ):
+            labels = self.groups[ color_scheme ][0]
+            colors = ( self._codes( color_scheme, self.last_datatype ), 
+                       group_palette( len( labels ) ), labels )
 
         # Call plot again, giving an explicit color mapping
         self._plot( self.last_datatype, colors )
 
+    def _codes( self, grouping, datatype ):
+        '''
+        Return the group codes of the points plotted for a datatype, selecting them
+        from the codes of every event or segment only the first time.
+        '''
+        key = ( grouping, datatype )
+        if key not in self.codes:
+            labels, event_codes, segment_codes = self.groups[ grouping ]
+            if datatype == 'event':
+                self.codes[ key ] = event_codes[ self.events ]
+            else:
+                self.codes[ key ] = segment_codes[ self.segments ]
+        return self.codes[ key ]
+
 class HMMImportWindow( Qt.QWidget ):
     '''
     Allows you to import a HMM from a text file, and specify a few ways of
-    making the model.
+    making the model. The imported model can be trained on the events of a sample
+    which are not excluded, in the background, with the fit of each iteration shown
+    as it finishes.
     '''
 
     def __init__( self, parent ):
@@ -995,6 +4160,10 @@ class HMMImportWindow( Qt.QWidget ):
         self.canvas.setParent( self )
         self.toolbar = NavigationToolbar( self.canvas, self )
         self.subplot = self.fig.add_subplot( 111 )
+        self.subplot.set_ylabel( "pA" )
+        self.subplot.set_xlabel( "Index" )
+        self.title = self.subplot.set_title( "" )
+        self.image = None
 
         grid = Qt.QGridLayout()
 
@@ -1012,80 +4181,146 @@ class HMMImportWindow( Qt.QWidget ):
         self.name.setText( "Test HMM" )
         grid.addWidget( self.name, 1, 2, 1, 2 )
 
+        # Initiate the training widgets
+        self.sampleBox = Qt.QComboBox()
+        for label in event_store( self.parent.experiment ).sample_labels:
+            self.sampleBox.addItem( label )
+        self.algorithmBox = Qt.QComboBox()
+        self.algorithmBox.addItems( TRAINING_ALGORITHMS )
+        self.trainButton = Qt.QPushButton( "Train" )
+        self.stopButton = Qt.QPushButton( "Stop" )
+        self.trainingStatus = Qt.QLabel( "" )
+        self.connect( self.trainButton, Qc.SIGNAL("clicked()"), self._train )
+        self.connect( self.stopButton, Qc.SIGNAL("clicked()"), self._stop_training )
+        grid.addWidget( Qt.QLabel( "Train On: " ), 2, 1 )
+        grid.addWidget( self.sampleBox, 2, 2 )
+        grid.addWidget( self.algorithmBox, 2, 3 )
+        grid.addWidget( self.trainButton, 2, 4 )
+        grid.addWidget( self.stopButton, 2, 5 )
+
         grid.addWidget( self.canvas, 3, 0, 20, 10 )
         grid.addWidget( self.toolbar, 23, 0, 1, 10 )
+        grid.addWidget( self.trainingStatus, 24, 0, 1, 10 )
+        if self.parent.training_worker is not None and self.parent.training_worker.isRunning():
+            self._attach( self.parent.training_worker )
 
         self.setLayout( grid )
 
     def _import( self ):
         '''
-        Organizes everything which occurs when the import button is hit. Builds a new HMM
-        and sticks it to the parent HMM dictionary.
+        Organizes everything which occurs when the import button is hit. Builds a new HMM,
+        or loads it from the model cache if the file was built before, and sticks it to the
+        parent HMM dictionary.
         '''
 
-        name = self.name.text()
-        distributions = self._read( self.hmmFile.text() )
-
-        hmm = ModularProfileModel( NanoporeGlobalAlignmentModule, 
-                                   distributions, 
-                                   str(name), 
-                                   insert=UniformDistribution(0,100) )
-        self.parent.hmms[ str(name) ] = hmm
+        name = str( self.name.text() )
+        distributions, hmm = self.parent.model_cache.build( str( self.hmmFile.text() ), name )
+        self.parent._register_hmm( name, hmm )
         self._draw_hmm( distributions )
 
-    def _read( self, filename ):
+    def _train( self ):
         '''
-        Reads in a properly formatted HMM generation file. All files must be line separated
-        distribution objects of proper python syntax, such as the following:
-
-
-        # This file stores the distributions of construct X
-        # Contact: Jacob Schreiber
-        #          jmschreiber@gmail.com
-        NormalDistribution( 4, 2 )
-        NormalDistribution( 2, 7 )
-        NormalDistribution( 2, 3 )
-        InverseGammaDistribution( 1, 0.5 )
-        GaussianKernelDensity( [ 0.4, 0.6, 0.3, 0.2, 0.6 ], bandwidth=0.5 )
-        GaussianKernelDensity( [ 6, 7, 6, 6.5, 6.4, 7.2, 4.1 ], bandwidth=0.1 )
-        LambdaDistribution( lambda x: 4 <= x <= 6 )
+        Import the HMM, then train it on the events of the selected sample which are
+        not excluded.
         '''
+        worker = self.parent.training_worker
+        if self.sampleBox.count() == 0 or ( worker is not None and worker.isRunning() ):
+            return
+        name = str( self.name.text() )
+        distributions, hmm = self.parent.model_cache.build( str( self.hmmFile.text() ), name )
+        store = event_store( self.parent.experiment )
+        events = self.parent.exclusion.kept()
+        events = events[ store.event_sample[ events ] == self.sampleBox.currentIndex() ]
+        worker = TrainingWorker( self.parent, name, distributions, events, 
+                                 str( self.algorithmBox.currentText() ) )
+        worker.trained.connect( self.parent._register_hmm )
+        self.parent.training_worker = worker
+        self._attach( worker )
+        worker.start()
+
+    def _stop_training( self ):
+        if self.parent.training_worker is not None:
+            self.parent.training_worker.stop()
+
+    def _attach( self, worker ):
+        ''' Connect this window to the signals of a running training. '''
+        self.trainButton.setEnabled( False )
+        self.trainingStatus.setText( "Training {}".format( worker.name ) )
+        worker.iteration.connect( self._iteration )
+        worker.error.connect( self._training_error )
+        worker.finished.connect( self._trained )
+
+    def _training_error( self, error ):
+        self.trainingStatus.setText( "{}: {}".format( error.__class__.__name__, error ) )
+
+    def _iteration( self, iteration, score, fit, distributions ):
+        ''' Show the fit of the model after an iteration, and the distributions it had. '''
+        self.trainingStatus.setText( "Iteration {}: mean log probability {:.3f} over {} events".format( 
+                                        iteration, score, fit ) )
+        self._draw_hmm( distributions )
 
-        with open( filename, 'r' ) as infile:
-            return map( eval, filter( lambda line: not line.startswith( '#' ), infile ) )
+    def _trained( self ):
+        self.trainButton.setEnabled( True )
+        worker = self.parent.training_worker
+        if worker.hmm is not None:
+            self.trainingStatus.setText( "{}, added as {} (trained)".format( 
+                                            self.trainingStatus.text(), worker.name ) )
+            self._draw_hmm( worker.distributions )
 
     def _draw_hmm( self, distributions ):
         '''
-        Draw an example of the consensus event.
+        Draw an example of the consensus event, as one image of the density of every
+        state over a grid of currents, with densities below .01 left blank.
         '''
-        plt.cla()
-        plt.title( "Probability Map For {}".format( str(self.name.text()) ) )
-        plt.ylabel( "pA" )
-        plt.xlabel( "Index" )
+        self.title.set_text( "Probability Map For {}".format( str(self.name.text()) ) )
         view = np.arange( 0, 120, .05 )
-
-        for i, distribution in enumerate( distributions ):
-            density = np.exp( map( distribution.log_probability, view ) )
-            for v, d in zip( view, density ):
-                if d > .01:
-                    self.subplot.plot( [i, i+1], [v, v], c='b', linewidth=2, alpha=d )
+        density = density_matrix( distributions, view )
+        density = np.ma.masked_less_equal( density, .01 ).T
+        extent = ( 0, len( distributions ), view[0], view[-1] )
+
+        if self.image is None:
+            self.image = self.subplot.imshow( density, origin='lower', aspect='auto', extent=extent,
+                                              interpolation='nearest', cmap='Blues', vmin=0, vmax=1 )
+            self.fig.colorbar( self.image, ax=self.subplot, label="Density" )
+        else:
+            self.image.set_data( density )
+            self.image.set_extent( extent )
+        self.subplot.set_xlim( extent[0], extent[1] )
+        self.subplot.set_ylim( extent[2], extent[3] )
         self.canvas.draw() 
 
 class MainPage( Qt.QMainWindow ):
     '''
     The main page of the application is the background to all of the 'viewer' windows. It will
     hold information which is passed between the various windows, but is primarily seen as the
-    toolbar on the top. This holds data such as the experiment tree and marked event indices 
-    for removal.
+    toolbar on the top. This holds data such as the experiment tree and the mask of events
+    excluded from analysis.
     '''
     def __init__( self ):
         super( MainPage, self ).__init__()
         self.experiment = Experiment( filenames=[] )
-        self.marked_event_indices = []
-        self.unmarked_event_indices = []
+        self.exclusion = ExclusionMask( 0 )
+        self.decodings = DecodeCache( event_store( self.experiment ) )
+        self.decode_worker = None
+        self.training_worker = None
+        self.workers = multiprocessing.cpu_count() # Worker processes used to decode and train HMMs
+        self.exclusion_rules = []
         self.saved_files = []
         self.input_files = []
         self.hmms = hmm_factory
+        self.model_cache = ModelCache()
+        self.hmms.update( self.model_cache.load() )
+        self.analysis_worker = None
+        self.analysis_cache = AnalysisCache()
+        self.db_pool = ConnectionPool()
+        self.schema = SchemaCache( self.db_pool )
+        self.query_executor = QueryExecutor( self )
+        self.query_executor.start()
+        self.render_cache = RenderCache()
+        self.prefetcher = Prefetcher( self.render_cache )
+        self.prefetcher.start()
+        self.query_results = ResultCache( lambda result: self.query_executor.submit( result.close, 
+                                                                    cancellable=False ) )
 
         self.setGeometry( 300, 300, 800, 500 )
         self.currentWindow = Logo( self )
@@ -1129,8 +4364,52 @@ class MainPage( Qt.QMainWindow ):
         self.show()
         sys.exit( app.exec_() )
 
+    def _analyzed( self, experiment ):
+        '''
+        Make a newly analyzed experiment the current one, with nothing excluded or
+        decoded. This runs in the GUI thread, so no window reads the experiment while
+        it changes. Event and analysis windows which are open are opened again on it.
+        The old experiment is deleted last, once nothing points at it any more.
+        '''
+        self.prefetcher.want( [] )
+        self.render_cache.clear()
+        old, self.experiment = self.experiment, experiment
+        self.input_files_n = [ file.n for file in experiment.files ]
+        self.exclusion = ExclusionMask( experiment.store.n_events )
+        self.decodings = DecodeCache( experiment.store )
+        if isinstance( self.centralWidget(), ( EventViewerWindow, AnalysisWindow ) ):
+            self.setCentralWidget( type( self.centralWidget() )( self ) )
+        old.delete()
+
+    def _analysis_finished( self ):
+        self.analysis_worker = None
+
+    def _register_hmm( self, name, hmm ):
+        '''
+        Add a HMM under a name, dropping whatever was decoded or drawn with any HMM
+        which had that name before.
+        '''
+        self.hmms[ name ] = hmm
+        self.decodings.invalidate( name )
+        self.render_cache.clear()
+
+    def closeEvent( self, event ):
+        '''
+        Stop every background thread and its worker processes before closing, as Qt
+        aborts if a thread is destroyed while it is still running.
+        '''
+        for worker in self.analysis_worker, self.decode_worker, self.training_worker:
+            if worker is not None and worker.isRunning():
+                worker.stop()
+                worker.wait()
+            if worker is not None and worker.pool is not None:
+                worker.pool.close( terminate=True )
+        self.query_executor.stop()
+        super( MainPage, self ).closeEvent( event )
+
 if __name__ == '__main__':
     import sys
+    multiprocessing.freeze_support()
     app = Qt.QApplication( sys.argv )
     MainPage()
     sys.exit( app.exec_() )
\ No newline at end of file
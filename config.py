@@ -15,4 +15,48 @@ DATABASE_PASSWORD = "OM0gFZzFzPmc+AuZ"  # Password to the database
 DATABASE_USER = "chenoo"                # If required, the username
 DATABASE = "chenoo"                     # The name of the database
 DATABASE_SOURCE = "NanoporeMetadata"    # Where filenames are stored
-MAX_DATABASE_SIZE = 10000               # Maximum number of rows in the database (overshoot this)
\ No newline at end of file
+DATABASE_PAGE_SIZE = 200                # Number of rows fetched at a time when browsing a table
+DATABASE_CACHED_PAGES = 50              # Number of fetched pages kept in memory per table
+DATABASE_CACHED_RESULTS = 8             # Number of recent search results kept for the database viewer
+
+# Analysis pipeline settings.
+
+ANALYSIS_WORKERS = 1                    # Default number of worker processes used to analyze files
+PROGRESS_INTERVAL = 0.1                 # Minimum number of seconds between progress bar updates
+PROGRESS_STEPS = 1000                   # Resolution of the progress bar
+ANALYSIS_CACHE_DIR = "abada_cache"      # Directory where analyzed files are cached
+ANALYSIS_CACHE_SIZE = 10 * 1024 ** 3    # Maximum size of the analysis cache in bytes
+STREAM_CHUNK_MB = 64                    # Size of the chunks read when streaming files from disk
+STREAM_OVERLAP = 10000                  # Number of samples shared by neighbouring chunks
+
+# Database settings used when saving and loading analyses.
+
+ANALYSIS_TABLE = "AnalysisMetadata"     # Table storing the parameters of each saved analysis
+EVENT_TABLE = "Events"                  # Table storing the events of each saved analysis
+SEGMENT_TABLE = "Segments"              # Table storing the segments of each saved analysis
+DATABASE_POOL_SIZE = 4                  # Maximum number of open database connections
+DATABASE_TIMEOUT = 30                   # Seconds to wait for a database connection before giving up
+DATABASE_BATCH_SIZE = 1000              # Number of rows sent in each multi-row insert
+
+# Output settings.
+
+EXPORT_CHUNK_SIZE = 100000              # Number of rows formatted at once when writing CSV files
+
+# Event viewer settings.
+
+PREFETCH_EVENTS = 5                     # Number of events on either side of the current one drawn ahead
+RENDER_CACHE_SIZE = 256 * 1024 ** 2     # Maximum size in bytes of the traces kept ready to draw
+
+# Analysis window settings.
+
+DENSITY_THRESHOLD = 100000              # Number of points above which scatter plots are drawn as densities
+DENSITY_MAX_BINS = 400                  # Maximum number of density bins along each axis
+
+# HMM settings.
+
+HMM_CACHE_DIR = "abada_cache/hmms"      # Directory where models built from HMM files are cached
+HMM_INSERT_RANGE = ( 0, 100 )           # Range of the uniform insert state of imported profile models
+DECODE_CHUNK_SIZE = 500                 # Number of events sent to a worker process at a time when decoding
+TRAINING_ITERATIONS = 20                # Most iterations of training a HMM on events
+TRAINING_THRESHOLD = 0.1                # Training stops once the mean log probability of events improves by less
+TRAINING_MIN_STD = 0.1                  # Smallest standard deviation (pA) of a trained distribution